@@ -0,0 +1,127 @@
+"""
+Local cache of converted assets.
+
+Entries are keyed by the content of the source file plus the converter and
+its options, so an unchanged source is never converted twice. The cache is
+bounded in size, the least recently used entries are evicted first. Its size
+is measured once and tracked as entries are stored; once over the bound, the
+cache is scanned and evicted down to EVICT_RATIO of it.
+
+The cache lives in $RS_UTILS_CACHE, ~/.cache/rs-utils by default.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+CACHE_DIR = os.environ.get('RS_UTILS_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache',
+                                        'rs-utils'))
+CACHE_SIZE = 2 * 1024**3 # bytes
+EVICT_RATIO = 0.9 # of CACHE_SIZE left after an eviction
+READ_SIZE = 1024**2
+
+
+def file_digest(filename):
+    """SHA1 of a file content"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fstream:
+        for chunk in iter(lambda: fstream.read(READ_SIZE), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def dir_size(path):
+    """Total size of the files of a directory tree"""
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+class AssetCache(object):
+    """Converted outputs stored by key. Outputs are stored by their suffix
+    after the source base name, so that identical sources with different
+    names share an entry."""
+
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = None # measured on the first put
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, filename, tool, options=''):
+        """Key of the conversion of a file by a tool with options"""
+        sha1 = hashlib.sha1()
+        sha1.update(file_digest(filename))
+        sha1.update('\0' + tool + '\0' + options)
+        return sha1.hexdigest()
+
+    def get(self, key, base, outdir):
+        """Copy the outputs of a cached conversion to outdir, named after
+        base. Returns the list of outputs, None if not cached."""
+        path = os.path.join(self.directory, key)
+        try:
+            suffixes = sorted(os.listdir(path))
+            outputs = []
+            for suffix in suffixes:
+                output = os.path.join(outdir, base + suffix)
+                shutil.copyfile(os.path.join(path, suffix), output)
+                outputs.append(output)
+            os.utime(path, None)
+        except EnvironmentError:
+            return None
+
+        return outputs
+
+    def put(self, key, base, outputs):
+        """Store the outputs of a conversion of a source named base"""
+        path = os.path.join(self.directory, key)
+        if os.path.exists(path):
+            return
+
+        # Copy to a temporary directory first, others may read the cache
+        tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            for output in outputs:
+                suffix = os.path.basename(output)[len(base):]
+                shutil.copyfile(output, os.path.join(tmpdir, suffix))
+            size = dir_size(tmpdir)
+            os.rename(tmpdir, path)
+        except EnvironmentError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+
+        with self.lock:
+            if self.size is None:
+                self.size = dir_size(self.directory)
+            else:
+                self.size += size
+            if self.size > self.max_size:
+                self.size = self.evict(int(self.max_size * EVICT_RATIO))
+
+    def evict(self, target=None):
+        """Remove least recently used entries until the cache fits in target
+        bytes, the maximum size by default. Returns the size left."""
+        target = self.max_size if target is None else target
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith('.'):
+                continue
+            try:
+                entries.append((os.path.getmtime(path), dir_size(path), path))
+            except EnvironmentError:
+                pass
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        return total
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""
+Run asset conversions in parallel. Each conversion runs in its own temporary
+work directory, so several of them can run at once. Outputs are cached by
+source content and the content of the bundled files converters depend on,
+see assetcache.py.
+
+    wav2wem     WAV to WEM with the Wwise CLI (see WwiseCLI)
+    wem2ogg     WEM to OGG with ww2ogg and revorb
+    img2dds     image to 64, 128 and 256 DDS, see dds.py
+    preview     WAV to a faded preview clip WEM, BASENAME_preview.wem, see
+                preview.py
+
+Usage:
+    assets.py (wav2wem | wem2ogg | img2dds | preview) [options] FILE...
+
+Options:
+    --jobs=N        Number of conversions run at once, all cores by default.
+    --retries=N     Retries of a failed conversion. [default: 1]
+    --outdir=DIR    Output directory. [default: .]
+    --cache-dir=DIR Cache directory, $RS_UTILS_CACHE or ~/.cache/rs-utils
+                    by default.
+    --no-cache      Always run the conversions.
+    --start=SEC     Start of the preview clip. [default: 0]
+    --length=SEC    Length of the preview clip. [default: 30]
+    --fade=SEC      Length of the preview fades. [default: 1]
+"""
+
+from multiprocessing.pool import ThreadPool
+import glob
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import wave
+
+from assetcache import AssetCache, CACHE_DIR, file_digest
+import preview
+
+THISPATH = os.path.dirname(os.path.abspath(__file__))
+
+WINE_ENV = dict(os.environ, WINEDEBUG='-all')
+DDS_SIZES = [64, 128, 256]
+LOG_TAIL = 20 # lines of the tool output shown for a failed job
+
+
+class JobError(Exception):
+    """A conversion failed"""
+    pass
+
+
+def basename(filename):
+    """File name without directory and extension"""
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def call(args, cwd, log):
+    """Run an external tool in cwd, its output going to log"""
+    returncode = subprocess.call(args, cwd=cwd, env=WINE_ENV,
+                                 stdout=log, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        tool = args[1] if args[0] == 'wine' else args[0]
+        raise JobError('{0} exited with status {1}'.format(
+                            os.path.basename(tool), returncode))
+
+def wine(tool, *args):
+    """Command line running one of the bundled Windows tools"""
+    return ['wine', os.path.join(THISPATH, tool)] + list(args)
+
+
+def extract_template(directory):
+    """Extract the Wwise template project once, returns its path"""
+    with tarfile.open(os.path.join(THISPATH, 'Template.tar.gz')) as tar:
+        tar.extractall(directory)
+    return os.path.join(directory, 'Template')
+
+def copy_template(workdir, context):
+    """Copy the template project to workdir, returns the path of its
+    copy and of its source WAV"""
+    template = os.path.join(workdir, 'Template')
+    shutil.copytree(context['template'], template)
+    return template, os.path.join(template, 'Originals', 'SFX', 'song.wav')
+
+def generate_wem(template, output, log):
+    """Generate the WEM of a template project copy, moved to output"""
+    call([os.path.join(THISPATH, 'WwiseCLI'), 'Template.wproj',
+          '-GenerateSoundBanks'], template, log)
+
+    wems = glob.glob(os.path.join(template, '.cache', 'Windows', 'SFX',
+                                  '*.wem'))
+    if not wems:
+        raise JobError('no WEM generated')
+
+    shutil.move(wems[0], output)
+    return [output]
+
+def wav2wem(filename, workdir, outdir, log, context):
+    """Convert a WAV to WEM in a copy of the template project"""
+    template, wav = copy_template(workdir, context)
+    shutil.copy(filename, wav)
+    return generate_wem(template, os.path.join(outdir,
+                                               basename(filename) + '.wem'),
+                        log)
+
+def wav2preview(filename, workdir, outdir, log, context):
+    """Convert the faded clip of a WAV to WEM, the clip is streamed straight
+    into the template project"""
+    template, wav = copy_template(workdir, context)
+    try:
+        preview.preview(filename, wav, *context['clip'])
+    except (ValueError, wave.Error) as exc:
+        raise JobError('preview clip: {0}'.format(exc))
+    return generate_wem(template, os.path.join(outdir, basename(filename) +
+                                               '_preview.wem'),
+                        log)
+
+def wem2ogg(filename, workdir, outdir, log, context):
+    """Convert a WEM to OGG"""
+    ogg = os.path.join(workdir, os.path.basename(filename) + '.ogg')
+    call(wine('ww2ogg.exe', filename, '-o', ogg,
+              '--pcb', os.path.join(THISPATH, 'packed_codebooks.bin')),
+         workdir, log)
+    call(wine('revorb.exe', ogg), workdir, log)
+
+    output = os.path.join(outdir, os.path.basename(ogg))
+    shutil.move(ogg, output)
+    return [output]
+
+def img2dds(filename, workdir, outdir, log, context):
+    """Convert an image to 3 DDS files"""
+    import dds
+
+    outputs = []
+    for dds_file in dds.img2dds(filename, workdir, DDS_SIZES):
+        output = os.path.join(outdir, os.path.basename(dds_file))
+        shutil.move(dds_file, output)
+        outputs.append(output)
+    return outputs
+
+CONVERTERS = {
+    'wav2wem' : wav2wem,
+    'wem2ogg' : wem2ogg,
+    'img2dds' : img2dds,
+    'preview' : wav2preview
+}
+
+# Bundled files each converter depends on, their content is part of the
+# cache keys
+DEPENDENCIES = {
+    'wav2wem' : ['Template.tar.gz', 'WwiseCLI'],
+    'wem2ogg' : ['ww2ogg.exe', 'revorb.exe', 'packed_codebooks.bin'],
+    'img2dds' : ['dds.py'],
+    'preview' : ['Template.tar.gz', 'WwiseCLI', 'preview.py']
+}
+
+def cache_options(name, context):
+    """Options of a converter in the cache keys: the digests of its
+    dependencies and the parameters of its outputs"""
+    options = [f + ':' + file_digest(os.path.join(THISPATH, f))
+               for f in DEPENDENCIES[name]]
+    if name == 'img2dds':
+        options += [str(size) for size in DDS_SIZES]
+    if 'clip' in context:
+        options += [str(value) for value in context['clip']]
+    return ' '.join(options)
+
+def prepare(name, directory, clip=None):
+    """Context shared by all the jobs of a converter, clip being the start,
+    length and fade of preview clips"""
+    context = {}
+    if name in ('wav2wem', 'preview'):
+        context['template'] = extract_template(directory)
+    if name == 'preview':
+        context['clip'] = clip or (preview.PREVIEW_START,
+                                   preview.PREVIEW_LENGTH,
+                                   preview.PREVIEW_FADE)
+    context['options'] = cache_options(name, context)
+    return context
+
+
+def run_job(name, filename, outdir, context, retries, cache=None):
+    """Run a conversion in its own work directory, with retries, unless its
+    outputs are in cache. Returns the filename, the list of outputs and an
+    error message."""
+    base = basename(filename)
+    if cache is not None:
+        key = cache.key(filename, name, context['options'])
+        outputs = cache.get(key, base, outdir)
+        if outputs is not None:
+            return filename, outputs, None
+
+    error = None
+    for _ in range(retries + 1):
+        workdir = tempfile.mkdtemp(prefix='rs-utils-')
+        try:
+            with open(os.path.join(workdir, 'job.log'), 'w+') as log:
+                try:
+                    outputs = CONVERTERS[name](filename, workdir, outdir, log,
+                                               context)
+                    if cache is not None:
+                        cache.put(key, base, outputs)
+                    return filename, outputs, None
+                except (JobError, EnvironmentError) as exc:
+                    log.seek(0)
+                    tail = log.read().splitlines()[-LOG_TAIL:]
+                    error = '\n'.join([str(exc)] + tail)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return filename, [], error
+
+def run_jobs(name, filenames, outdir='.', jobs=None, retries=1, cache=None,
+             clip=None):
+    """Run the conversions of a list of files, at most jobs at once, clip
+    being the start, length and fade of preview clips. Returns a list of
+    (filename, outputs, error)."""
+    outdir = os.path.abspath(outdir)
+    filenames = [os.path.abspath(f) for f in filenames]
+
+    shared = tempfile.mkdtemp(prefix='rs-utils-')
+    pool = ThreadPool(jobs)
+    try:
+        context = prepare(name, shared, clip)
+
+        def job(filename):
+            """Job for the pool"""
+            return run_job(name, filename, outdir, context, retries, cache)
+
+        results = []
+        for result in pool.imap_unordered(job, filenames):
+            filename, outputs, error = result
+            if error is None:
+                print '{0}: {1}'.format(filename, ' '.join(outputs))
+            else:
+                print '{0}: FAILED\n{1}'.format(filename, error)
+            sys.stdout.flush()
+            results.append(result)
+        return results
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(shared, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    name = [n for n in CONVERTERS if args[n]][0]
+    jobs = int(args['--jobs']) if args['--jobs'] else None
+    cache = None
+    if not args['--no-cache']:
+        cache = AssetCache(args['--cache-dir'] or CACHE_DIR)
+    clip = (float(args['--start']), float(args['--length']),
+            float(args['--fade']))
+    results = run_jobs(name, args['FILE'], args['--outdir'], jobs,
+                       int(args['--retries']), cache, clip)
+
+    failed = [r for r in results if r[2] is not None]
+    if failed:
+        print '{0}/{1} conversions failed'.format(len(failed), len(results))
+        sys.exit(1)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+
+"""
+Benchmark PSARC packing and SNG compilation on synthetic inputs.
+
+The PSARC tree holds WEM sized random blobs, compressible JSON manifests and
+a compiled SNG. The Rocksmith XML has random notes and chords over a number
+of levels and phrase iterations. Each stage is run --repeat times on fresh
+inputs and the best time is kept.
+
+Usage: bench.py [options]
+
+Options:
+    --files=N           WEM files in the PSARC tree. [default: 8]
+    --size=KB           Size of a WEM file. [default: 2048]
+    --notes=N           Notes of the hardest level. [default: 2000]
+    --levels=N          Levels of the XML. [default: 8]
+    --iterations=N      Phrase iterations of the XML. [default: 40]
+    --repeat=N          Runs of each stage. [default: 3]
+    --seed=N            Seed of the synthetic inputs. [default: 0]
+    --output=FILE       Save the results as JSON.
+    --baseline=FILE     Compare with results saved by --output.
+    --threshold=PCT     Slowdown of a stage reported as a regression.
+                        [default: 10]
+"""
+
+from contextlib import contextmanager
+from cStringIO import StringIO
+from timeit import default_timer as timer
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import psarc
+import sngparser
+import xml2sng
+
+MB = 1024.0**2
+
+# Passes of xml2sng.process_sng timed on their own
+PASSES = ['song_timing', 'process_ebeats', 'compile_chord_templates',
+          'process_phrase_iterations', 'process_sections', 'process_level',
+          'process_metadata']
+
+
+@contextmanager
+def quiet():
+    """Silence the progress output of the benchmarked functions"""
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        yield
+    finally:
+        sys.stdout = stdout
+
+@contextmanager
+def timed_functions(module, names, totals):
+    """Accumulate the time spent in functions of a module into totals, a
+    dictionary name -> seconds, while in the context"""
+    originals = dict((name, getattr(module, name)) for name in names)
+
+    def wrap(name, function):
+        """Timed version of function"""
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                totals[name] = totals.get(name, 0.0) + timer() - start
+        return timed
+
+    for name, function in originals.items():
+        setattr(module, name, wrap(name, function))
+    try:
+        yield totals
+    finally:
+        for name, function in originals.items():
+            setattr(module, name, function)
+
+
+def synthetic_xml(notes=2000, levels=8, iterations=40, seed=0):
+    """Rocksmith XML of a song with random notes and chords over levels, the
+    hardest level holding about notes of them. Returns the XML as a
+    string."""
+    rand = random.Random(seed)
+    length = max(60.0, notes / 8.0)
+    start = length / iterations
+    out = []
+    w = out.append
+
+    w('<?xml version="1.0" encoding="utf-8"?>\n<song version="7">')
+    w('<title>Benchmark</title><arrangement>Lead</arrangement>'
+      '<part>1</part><offset>-10.000</offset>')
+    w('<songLength>%.3f</songLength><capo>0</capo>' % length)
+    w('<lastConversionDateTime>1-1-15 00:00</lastConversionDateTime>')
+    w('<tuning string0="0" string1="0" string2="0" string3="0" string4="0" '
+      'string5="0" />')
+
+    beats = int(length / 0.5)
+    w('<ebeats count="%d">' % beats)
+    for i in range(beats):
+        w('<ebeat time="%.3f" measure="%d" />' %
+          (i * 0.5, i // 4 if i % 4 == 0 else -1))
+    w('</ebeats>')
+
+    w('<phrases count="3">')
+    for i, name in enumerate(['COUNT', 'riff', 'END']):
+        w('<phrase disparity="0" ignore="0" maxDifficulty="%d" name="%s" '
+          'solo="0" />' % (levels - 1 if i == 1 else 0, name))
+    w('</phrases>')
+    w('<phraseIterations count="%d">' % iterations)
+    for i in range(iterations):
+        phrase = 0 if i == 0 else (2 if i == iterations - 1 else 1)
+        w('<phraseIteration time="%.3f" phraseId="%d" variation="">'
+          '<heroLevels count="1"><heroLevel hero="1" difficulty="0" />'
+          '</heroLevels></phraseIteration>' % (i * start, phrase))
+    w('</phraseIterations>')
+    w('<newLinkedDiffs count="1"><newLinkedDiff levelBreak="-1" '
+      'ratio="1.000" phrases="1"><nld_phrase id="1" /><nld_phrase id="2" />'
+      '</newLinkedDiff></newLinkedDiffs>')
+    w('<linkedDiffs count="0" /><phraseProperties count="0" />')
+
+    templates = 8
+    w('<chordTemplates count="%d">' % templates)
+    for i in range(templates):
+        frets = [3, 5] + [rand.choice([-1, 0, 2, 3, 5]) for _ in range(4)]
+        fingers = ' '.join('fret%d="%d" finger%d="%d"' %
+                           (k, f, k, -1 if f <= 0 else 1)
+                           for k, f in enumerate(frets))
+        w('<chordTemplate chordName="C%d" displayName="C%d%s" %s />' %
+          (i, i, '-arp' if i % 3 == 0 else '', fingers))
+    w('</chordTemplates>')
+    w('<fretHandMuteTemplates count="0" />')
+    w('<events count="2"><event time="10.000" code="B0" />'
+      '<event time="20.000" code="dna_riff" /></events>')
+    w('<sections count="2"><section name="intro" number="1" '
+      'startTime="%.3f" /><section name="verse" number="1" '
+      'startTime="%.3f" /></sections>' % (start, length / 2))
+
+    def note(time, string, fret, sustain):
+        """Attributes of a note"""
+        return ('time="%.3f" linkNext="0" accent="%d" bend="0" fret="%d" '
+                'hammerOn="%d" harmonic="0" hopo="0" ignore="0" '
+                'leftHand="-1" mute="0" palmMute="%d" pluck="-1" pullOff="0" '
+                'slap="-1" slideTo="-1" string="%d" sustain="%.3f" '
+                'tremolo="0" harmonicPinch="0" pickDirection="0" '
+                'rightHand="-1" slideUnpitchTo="-1" tap="0" vibrato="0"' %
+                (time, rand.random() < 0.1, fret, rand.random() < 0.1,
+                 rand.random() < 0.1, string, sustain))
+
+    w('<levels count="%d">' % levels)
+    for level in range(levels):
+        count = notes * (level + 1) // levels
+        times = sorted(set(round(rand.uniform(start, length - 5), 3)
+                           for _ in range(count)))
+        single, chords = [], []
+        for t in times:
+            if rand.random() < 0.3:
+                chord_notes = ''.join('<chordNote %s />' %
+                                      note(t, s, rand.randint(0, 5), 0.0)
+                                      for s in range(2))
+                chords.append('<chord time="%.3f" linkNext="0" accent="0" '
+                              'chordId="%d" fretHandMute="0" highDensity="%d" '
+                              'ignore="0" palmMute="0" hopo="0" strum="down">'
+                              '%s</chord>' % (t, rand.randrange(templates),
+                                              rand.random() < 0.3,
+                                              chord_notes))
+            else:
+                sustain = rand.choice([0.0, 0.0, 0.5, 1.25])
+                single.append('<note %s />' % note(t, rand.randrange(6),
+                                                   rand.randint(0, 12),
+                                                   sustain))
+        w('<level difficulty="%d">' % level)
+        w('<notes count="%d">%s</notes>' % (len(single), ''.join(single)))
+        w('<chords count="%d">%s</chords>' % (len(chords), ''.join(chords)))
+        w('<fretHandMutes count="0" />')
+        w('<anchors count="1"><anchor time="%.3f" fret="1" width="4.000" />'
+          '</anchors>' % start)
+        shapes = []
+        t = start
+        while t < length - 10:
+            duration = rand.uniform(1, 6)
+            shapes.append('<handShape chordId="%d" startTime="%.3f" '
+                          'endTime="%.3f" />' %
+                          (rand.randrange(templates), t, t + duration))
+            t += duration + rand.uniform(1, 6)
+        w('<handShapes count="%d">%s</handShapes>' % (len(shapes),
+                                                      ''.join(shapes)))
+        w('</level>')
+    w('</levels></song>')
+
+    return '\n'.join(out)
+
+def synthetic_tree(files=8, size=2048 * 1024, sng='', seed=0):
+    """Dictionary filepath -> data of a Mac PSARC: random WEM, JSON manifests
+    and the given SNG"""
+    rand = random.Random(seed)
+    tree = {}
+    for i in range(files):
+        name = 'bench{0}'.format(i)
+        tree['audio/mac/song_{0}.wem'.format(name)] = os.urandom(size)
+        manifest = {'Entries': {name: {'Attributes': dict(
+            ('Key{0}'.format(k), rand.random()) for k in range(200))}}}
+        tree['manifests/songs_dlc_bench/{0}_lead.json'.format(name)] = \
+            json.dumps(manifest, indent=2, sort_keys=True)
+    tree['songs/bin/macos/bench_lead.sng'] = sng
+    tree['bench_aggregategraph.nt'] = \
+        '<urn:database:sng-db:bench_lead> <songs/bin/macos/bench_lead.sng>\n'
+    return tree
+
+
+def best_time(function, setup=None, repeat=3):
+    """Best time of function over repeat runs, setup being called before
+    each run to provide its arguments"""
+    best = None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = timer()
+        function(*args)
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def stage(seconds, amount, unit):
+    """Result of a stage: time and throughput in unit per second"""
+    return {
+        'seconds' : seconds,
+        'amount'  : amount,
+        'unit'    : unit,
+        'rate'    : amount / seconds if seconds else 0.0
+    }
+
+def bench_sng(xml_file, repeat=3):
+    """Benchmark loading, compiling and building a SNG. Returns the results
+    and the built SNG."""
+    results = {}
+
+    sng = xml2sng.load_rsxml(xml_file)
+    notes = sum(len(l.notes) + len(l.chords) for l in sng.levels)
+
+    seconds = best_time(xml2sng.load_rsxml, lambda: (xml_file,), repeat)
+    results['xml.load'] = stage(seconds, notes, 'notes')
+
+    passes = {}
+    for _ in range(repeat):
+        sng = xml2sng.load_rsxml(xml_file)
+        totals = {}
+        with timed_functions(xml2sng, PASSES, totals):
+            start = timer()
+            xml2sng.process_sng(sng)
+            totals['process_sng'] = timer() - start
+        for name, seconds in totals.items():
+            passes[name] = min(passes.get(name, seconds), seconds)
+    for name, seconds in passes.items():
+        results['sng.' + name] = stage(seconds, notes, 'notes')
+
+    seconds = best_time(sngparser.SONG.build, lambda: (sng,), repeat)
+    results['sng.build'] = stage(seconds, notes, 'notes')
+
+    return results, sngparser.SONG.build(sng)
+
+def bench_psarc(tree, workdir, repeat=3):
+    """Benchmark the PSARC stages on a dictionary filepath -> data"""
+    results = {}
+    total = sum(len(data) for data in tree.values()) / MB
+
+    sng = tree['songs/bin/macos/bench_lead.sng']
+    payload = psarc.compress_sng(sng)
+    seconds = best_time(psarc.compress_sng, lambda: (sng,), repeat)
+    results['crypto.compress_sng'] = stage(seconds, len(sng) / MB, 'MB')
+
+    seconds = best_time(psarc.encrypt_sng,
+                        lambda: (sng, psarc.MAC_KEY, payload), repeat)
+    results['crypto.encrypt_sng'] = stage(seconds, len(payload) / MB, 'MB')
+
+    encrypted = psarc.encrypt_sng(sng, psarc.MAC_KEY, payload)
+    seconds = best_time(psarc.decrypt_sng,
+                        lambda: (encrypted, psarc.MAC_KEY), repeat)
+    results['crypto.decrypt_sng'] = stage(seconds, len(payload) / MB, 'MB')
+
+    def create_entries(policy):
+        """Compress all the files"""
+        return dict((name, psarc.create_entry(name, data, policy=policy))
+                    for name, data in tree.items())
+
+    for name in ('best', 'fast'):
+        seconds = best_time(create_entries,
+                            lambda: (psarc.POLICIES[name],), repeat)
+        results['compress.' + name] = stage(seconds, total, 'MB')
+
+    entries = psarc.archive_entries(create_entries(psarc.POLICIES['fast']))
+    image = psarc.create_toc(entries) + \
+            ''.join(e['data'] for e in psarc.layout_order(entries)
+                    if not e['duplicate'])
+    seconds = best_time(psarc.create_toc, lambda: (entries,), repeat)
+    results['toc.create'] = stage(seconds, len(entries), 'entries')
+    seconds = best_time(psarc.read_toc, lambda: (StringIO(image),), repeat)
+    results['toc.read'] = stage(seconds, len(entries), 'entries')
+
+    filename = os.path.join(workdir, 'bench_m.psarc')
+    with quiet():
+        seconds = best_time(psarc.create_psarc, lambda: (tree, filename),
+                            repeat)
+    results['psarc.pack'] = stage(seconds, total, 'MB')
+
+    def unpack():
+        """Read all the entries"""
+        with open(filename, 'rb') as fstream:
+            for entry in psarc.read_toc(fstream):
+                psarc.read_entry(fstream, entry)
+
+    seconds = best_time(unpack, repeat=repeat)
+    results['psarc.unpack'] = stage(seconds, total, 'MB')
+
+    with quiet():
+        seconds = best_time(psarc.convert, lambda: (filename,), repeat)
+    results['psarc.convert'] = stage(seconds, total, 'MB')
+
+    return results
+
+def run(args):
+    """Run all the benchmarks, returns the results"""
+    params = dict((k.lstrip('-'), int(args[k])) for k in
+                  ['--files', '--size', '--notes', '--levels', '--iterations',
+                   '--repeat', '--seed'])
+
+    workdir = tempfile.mkdtemp(prefix='rs-bench-')
+    try:
+        xml_file = os.path.join(workdir, 'bench.xml')
+        with open(xml_file, 'w') as fstream:
+            fstream.write(synthetic_xml(params['notes'], params['levels'],
+                                        params['iterations'], params['seed']))
+        stages, sng = bench_sng(xml_file, params['repeat'])
+
+        tree = synthetic_tree(params['files'], params['size'] * 1024, sng,
+                              params['seed'])
+        stages.update(bench_psarc(tree, workdir, params['repeat']))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'date'     : time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python'   : platform.python_version(),
+        'platform' : platform.platform(),
+        'params'   : params,
+        'stages'   : stages
+    }
+
+def compare(results, baseline, threshold):
+    """Print the results next to a baseline. Returns the list of stages
+    slower than the baseline by more than threshold percents."""
+    regressions = []
+    print '{0:32} {1:>9} {2:>20} {3:>20} {4:>8}'.format(
+            'stage', 'seconds', 'rate', 'baseline', 'change')
+    for name, current in sorted(results['stages'].items()):
+        unit = current['unit'] + '/s'
+        line = '{0:32} {1:9.4f} {2:>20}'.format(
+                name, current['seconds'],
+                '{0:.1f} {1}'.format(current['rate'], unit))
+
+        reference = baseline['stages'].get(name) if baseline else None
+        if reference and reference['rate']:
+            change = 100.0 * (current['rate'] / reference['rate'] - 1)
+            line += ' {0:>20} {1:+7.1f}%'.format(
+                        '{0:.1f} {1}'.format(reference['rate'], unit), change)
+            if change < -threshold:
+                line += ' REGRESSION'
+                regressions.append(name)
+        print line
+
+    if baseline and baseline['params'] != results['params']:
+        print 'Warning: baseline parameters differ', baseline['params']
+    return regressions
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    results = run(args)
+
+    baseline = None
+    if args['--baseline']:
+        with open(args['--baseline']) as fstream:
+            baseline = json.load(fstream)
+    regressions = compare(results, baseline, float(args['--threshold']))
+
+    if args['--output']:
+        with open(args['--output'], 'w') as fstream:
+            json.dump(results, fstream, indent=2, sort_keys=True)
+
+    if regressions:
+        print '{0} regressions'.format(len(regressions))
+        sys.exit(1)
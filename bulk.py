@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+Unpack or convert whole PSARC libraries across all cores.
+
+PATH is an archive, a glob or a directory searched for *.psarc. Archives are
+spread over a process pool. Each finished archive is appended to a journal,
+keyed by the SHA1 of its content, so an interrupted run resumes where it
+stopped when run again. A failing archive is recorded in the journal and
+does not stop the others, it is not retried unless --retry-failed.
+
+Converted archives are written to --outdir. Outputs recorded in the journal
+are not taken as inputs, and an archive is not converted when its output
+would overwrite an input of the run or the output of another archive.
+
+Usage:
+    bulk.py unpack [options] PATH...
+    bulk.py convert [options] [--dedup] [--fast] [--compress=RULES]
+                    [--layout=LAYOUT] [--block-size=SIZE] PATH...
+
+Options:
+    --jobs=N            Number of worker processes, all cores by default.
+    --journal=FILE      Journal of the run. [default: psarc-bulk.journal]
+    --retry-failed      Process archives that failed in a previous run.
+    --outdir=DIR        Directory archives are unpacked or converted to.
+                        [default: .]
+    --dedup             Store identical files once.
+    --fast              Use the fast compression policy, for development.
+    --compress=RULES    Comma separated GLOB:LEVEL rules applied before the
+                        policy ones, LEVEL being 0-9 or store.
+    --layout=LAYOUT     Order of the entry blocks, grouped or sorted, see
+                        psarc.py. [default: grouped]
+    --block-size=SIZE   Block size of the converted archives.
+                        [default: 65536]
+"""
+
+from multiprocessing import Pool, TimeoutError
+import fnmatch
+import glob
+import json
+import os
+import signal
+import sys
+
+from assetcache import file_digest
+import psarc
+
+POLL_TIMEOUT = 3600 # seconds, lets the pool iteration be interrupted
+
+
+def find_archives(paths):
+    """Sorted list of the archives of paths, being files, globs or
+    directories"""
+    archives = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in fnmatch.filter(filenames, '*.psarc'):
+                    archives.add(os.path.join(dirpath, filename))
+        else:
+            archives.update(f for f in glob.glob(path) if os.path.isfile(f))
+    return sorted(archives)
+
+def journal_key(operation, digest, options):
+    """Key of an archive in the journal"""
+    return '{0} {1} {2}'.format(operation, digest,
+                                json.dumps(options, sort_keys=True))
+
+def read_journal(filename):
+    """Dictionary key -> last record of the journal. A line cut short by an
+    interruption is ignored."""
+    records = {}
+    if not os.path.exists(filename):
+        return records
+
+    with open(filename) as fstream:
+        for line in fstream:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['key']] = record
+    return records
+
+def append_journal(fstream, record):
+    """Append a record to the journal, on disk before returning"""
+    fstream.write(json.dumps(record, sort_keys=True) + '\n')
+    fstream.flush()
+    os.fsync(fstream.fileno())
+
+
+SKIP = set()
+REFUSED = {} # archive -> why it is not processed
+
+def init_worker(skip, refused):
+    """Pool initializer: keys to skip, archives refused, no progress
+    output, interruptions left to the parent"""
+    SKIP.update(skip)
+    REFUSED.update(refused)
+    sys.stdout = open(os.devnull, 'w')
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def run_archive(job):
+    """Unpack or convert an archive unless its key is to be skipped.
+    Returns its journal record."""
+    operation, filename, options = job
+    record = {
+        'operation' : operation,
+        'input'     : filename,
+        'options'   : options,
+        'outputs'   : []
+    }
+    try:
+        record['digest'] = file_digest(filename)
+        record['key'] = journal_key(operation, record['digest'], options)
+        if record['key'] in SKIP:
+            record['status'] = 'skipped'
+            return record
+
+        if operation == 'unpack':
+            output = psarc.extract_psarc(filename, options['outdir'],
+                                         strict=True)
+        else:
+            if filename in REFUSED:
+                raise ValueError(REFUSED[filename])
+            output = psarc.convert(filename, options['policy'],
+                                   options['dedup'], True, options['outdir'])
+        record['outputs'] = [output]
+        record['status'] = 'done'
+    except Exception as exc:
+        record['status'] = 'failed'
+        record['error'] = '{0}: {1}'.format(type(exc).__name__, exc)
+    return record
+
+def next_record(iterator):
+    """Next record of a pool iterator, waiting as long as the archive takes
+    while letting the wait be interrupted"""
+    while True:
+        try:
+            return iterator.next(POLL_TIMEOUT)
+        except TimeoutError:
+            pass
+
+def refused_conversions(archives, outdir):
+    """Dictionary archive -> why it is not converted: not a _m or _p
+    archive, or its output is an input or the output of another archive"""
+    refused = {}
+    outputs = {}
+    inputs = set(os.path.abspath(f) for f in archives)
+    for filename in archives:
+        if not filename.endswith(('_m.psarc', '_p.psarc')):
+            refused[filename] = 'not a _m or _p archive'
+            continue
+        output = os.path.abspath(psarc.converted_name(filename, outdir))
+        if output in inputs:
+            refused[filename] = 'output {0} is an input'.format(output)
+        outputs.setdefault(output, []).append(filename)
+
+    for output, filenames in outputs.items():
+        if len(filenames) > 1:
+            for filename in filenames:
+                others = [f for f in filenames if f != filename]
+                refused.setdefault(filename, 'output {0} shared with {1}'
+                                   .format(output, ', '.join(others)))
+    return refused
+
+def run_bulk(operation, paths, options, journal, jobs=None,
+             retry_failed=False):
+    """Run an operation over the archives of paths, options being passed to
+    it. Returns the list of records, skipped archives included."""
+    records = read_journal(journal)
+    statuses = ['done'] if retry_failed else ['done', 'failed']
+    skip = [key for key, record in records.items()
+            if record['status'] in statuses]
+
+    outputs = set(os.path.abspath(output) for record in records.values()
+                  for output in record['outputs'])
+    archives = [f for f in find_archives(paths)
+                if os.path.abspath(f) not in outputs]
+    refused = {}
+    if operation == 'convert':
+        refused = refused_conversions(archives, options['outdir'])
+
+    results = []
+    pool = Pool(jobs, init_worker, (skip, refused))
+    try:
+        with open(journal, 'a') as fstream:
+            tasks = [(operation, filename, options) for filename in archives]
+            iterator = pool.imap_unordered(run_archive, tasks)
+            for _ in archives:
+                record = next_record(iterator)
+                if record['status'] != 'skipped':
+                    append_journal(fstream, record)
+
+                line = '{0}: {1}'.format(record['input'], record['status'])
+                if record['status'] == 'failed':
+                    line += ', ' + record['error']
+                print line
+                sys.stdout.flush()
+                results.append(record)
+    except KeyboardInterrupt:
+        print 'Interrupted, run again to resume'
+        raise
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return results
+
+if __name__ == '__main__':
+    from docopt import docopt, DocoptExit
+    args = docopt(__doc__)
+
+    operation = 'unpack' if args['unpack'] else 'convert'
+    if operation == 'unpack':
+        options = {'outdir' : os.path.abspath(args['--outdir'])}
+    else:
+        try:
+            options = {'outdir' : os.path.abspath(args['--outdir']),
+                       'policy' : psarc.args_policy(args),
+                       'dedup'  : args['--dedup']}
+        except ValueError as exc:
+            raise DocoptExit(str(exc))
+
+    try:
+        results = run_bulk(operation, args['PATH'], options, args['--journal'],
+                           int(args['--jobs']) if args['--jobs'] else None,
+                           args['--retry-failed'])
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+    counts = dict((s, len([r for r in results if r['status'] == s]))
+                  for s in ['done', 'skipped', 'failed'])
+    print '{done} done, {skipped} skipped, {failed} failed'.format(**counts)
+    if counts['failed']:
+        sys.exit(1)
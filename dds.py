@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+"""
+Generate the 64, 128 and 256 DDS files of an image for Rocksmith 2014
+album art, DXT1 compressed with 1 bit alpha.
+
+The image is loaded once and box downscaled to every size, blocks are
+compressed with NumPy over all the 4x4 tiles at once. Requires numpy and PIL.
+
+Usage: dds.py [--outdir=DIR] FILE...
+
+Options:
+    --outdir=DIR    Output directory. [default: .]
+"""
+
+import os
+import struct
+
+import numpy
+from PIL import Image
+
+DDS_SIZES = [64, 128, 256]
+ALPHA_THRESHOLD = 128
+
+DDSD_FLAGS = 0x1 | 0x2 | 0x4 | 0x1000 | 0x80000 # caps, size, pixel format,
+                                                # linear size
+DDPF_FOURCC = 0x4
+DDSCAPS_TEXTURE = 0x1000
+
+BLOCK = numpy.dtype([('color0', '<u2'), ('color1', '<u2'), ('indices', '<u4')])
+
+
+def load_image(filename):
+    """Load an image in RGBA mode"""
+    return Image.open(filename).convert('RGBA')
+
+def downscale(image, sizes=DDS_SIZES):
+    """Box downscale an image to all the sizes, largest first. The largest is
+    resized from the image, each other one is averaged from the previous
+    one when possible. Returns a dictionary size -> float RGBA array."""
+    sizes = sorted(sizes, reverse=True)
+    largest = image.resize((sizes[0], sizes[0]), Image.BOX)
+
+    output = {sizes[0]: numpy.asarray(largest, dtype=numpy.float32)}
+    for previous, size in zip(sizes[:-1], sizes[1:]):
+        pixels = output[previous]
+        factor = previous // size
+        if previous % size == 0:
+            output[size] = pixels.reshape(size, factor, size, factor, 4) \
+                                 .mean(axis=(1, 3))
+        else:
+            resized = image.resize((size, size), Image.BOX)
+            output[size] = numpy.asarray(resized, dtype=numpy.float32)
+
+    return output
+
+def tiles(pixels):
+    """Split a HxWx4 array into an array of 4x4 tiles, N x 16 x 4"""
+    height, width = pixels.shape[:2]
+    return pixels.reshape(height // 4, 4, width // 4, 4, 4) \
+                 .transpose(0, 2, 1, 3, 4).reshape(-1, 16, 4)
+
+def to_565(colors):
+    """Pack float RGB colors to RGB565"""
+    rgb = numpy.clip(numpy.rint(colors), 0, 255).astype(numpy.uint32)
+    return ((rgb[..., 0] >> 3) << 11) | ((rgb[..., 1] >> 2) << 5) | \
+           (rgb[..., 2] >> 3)
+
+def from_565(packed):
+    """Unpack RGB565 colors to float RGB, as decoded by the hardware"""
+    red = (packed >> 11) & 0x1f
+    green = (packed >> 5) & 0x3f
+    blue = packed & 0x1f
+    return numpy.stack([(red << 3) | (red >> 2),
+                        (green << 2) | (green >> 4),
+                        (blue << 3) | (blue >> 2)], axis=-1) \
+                .astype(numpy.float32)
+
+def compress_dxt1(pixels):
+    """DXT1 compress a RGBA float array, pixels with an alpha lower than
+    ALPHA_THRESHOLD become transparent. Returns the raw blocks."""
+    blocks = tiles(pixels)
+    colors = blocks[..., :3]
+    opaque = blocks[..., 3] >= ALPHA_THRESHOLD
+    transparent = ~opaque.all(axis=1)
+
+    # Endpoints from the bounding box of the opaque pixels, slightly inset
+    inf = numpy.float32(numpy.inf)
+    lowest = numpy.where(opaque[..., None], colors, inf).min(axis=1)
+    highest = numpy.where(opaque[..., None], colors, -inf).max(axis=1)
+    empty = ~opaque.any(axis=1)
+    lowest[empty] = 0
+    highest[empty] = 0
+    inset = (highest - lowest) / 16
+    highest -= inset
+    lowest += inset
+
+    # Pick the box diagonal following the covariance of the channels with
+    # the channel of largest spread
+    weights = opaque[..., None].astype(numpy.float32)
+    count = numpy.maximum(weights.sum(axis=1), 1)
+    centered = (colors - (colors * weights).sum(axis=1)[:, None, :] /
+                count[:, None, :]) * weights
+    main = (highest - lowest).argmax(axis=1)
+    covariance = (centered *
+                  centered[numpy.arange(len(blocks)), :, main][..., None]) \
+                    .sum(axis=1)
+    flip = covariance < 0
+    highest, lowest = numpy.where(flip, lowest, highest), \
+                      numpy.where(flip, highest, lowest)
+
+    color0 = to_565(highest)
+    color1 = to_565(lowest)
+
+    # 4 colors mode needs color0 > color1, 3 colors and transparent mode
+    # needs color0 <= color1
+    swap = numpy.where(transparent, color0 > color1, color0 < color1)
+    color0, color1 = numpy.where(swap, color1, color0), \
+                     numpy.where(swap, color0, color1)
+
+    # Position of each pixel along the decoded endpoints line
+    start = from_565(color0)[:, None, :]
+    axis = from_565(color1)[:, None, :] - start
+    norm = (axis * axis).sum(axis=2)
+    norm[norm == 0] = 1
+    position = ((colors - start) * axis).sum(axis=2) / norm
+    position = numpy.clip(position, 0, 1)
+
+    # Palettes are ordered c0, c1, then interpolated colors
+    four = numpy.array([0, 2, 3, 1], dtype=numpy.uint32)
+    three = numpy.array([0, 2, 1], dtype=numpy.uint32)
+    indices = numpy.where(transparent[:, None],
+                          three[numpy.rint(position * 2).astype(int)],
+                          four[numpy.rint(position * 3).astype(int)])
+    indices[~opaque] = 3
+
+    # With equal endpoints of an opaque block, the 3 colors mode applies
+    indices[(color0 == color1) & ~transparent] = 0
+
+    output = numpy.zeros(len(blocks), dtype=BLOCK)
+    output['color0'] = color0
+    output['color1'] = color1
+    shifts = 2 * numpy.arange(16, dtype=numpy.uint32)
+    output['indices'] = (indices << shifts).sum(axis=1, dtype=numpy.uint32)
+    return output.tostring()
+
+def dds_header(width, height):
+    """DDS magic and header of a DXT1 texture without mipmaps"""
+    linear_size = max(1, (width + 3) // 4) * max(1, (height + 3) // 4) * 8
+    header = struct.pack('<4s7L', 'DDS ', 124, DDSD_FLAGS, height, width,
+                         linear_size, 0, 0)
+    header += 11 * struct.pack('<L', 0)
+    header += struct.pack('<2L4s5L', 32, DDPF_FOURCC, 'DXT1', 0, 0, 0, 0, 0)
+    header += struct.pack('<5L', DDSCAPS_TEXTURE, 0, 0, 0, 0)
+    return header
+
+def img2dds(filename, outdir='', sizes=DDS_SIZES):
+    """Write the DDS of every size for an image, named BASENAME_SIZE.dds.
+    Returns the list of DDS file names."""
+    base = os.path.basename(os.path.splitext(filename)[0])
+    scaled = downscale(load_image(filename), sizes)
+
+    outputs = []
+    for size in sizes:
+        output = os.path.join(outdir, '{0}_{1}.dds'.format(base, size))
+        with open(output, 'wb') as fstream:
+            fstream.write(dds_header(size, size))
+            fstream.write(compress_dxt1(scaled[size]))
+        outputs.append(output)
+
+    return outputs
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    for f in args['FILE']:
+        for output in img2dds(f, args['--outdir']):
+            print output
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""
+Build PC and Mac PSARC for Rocksmith 2014 straight from Rocksmith XML and
+asset files. SNG are compiled once, in memory, and encrypted per platform.
+
+Usage: pipeline.py [--assets=DIR] [--dedup] [--fast] NAME XML...
+
+Options:
+    --assets=DIR    Directory of asset files to pack along the SNG.
+    --dedup         Store identical files once.
+    --fast          Use the fast compression policy, for development.
+"""
+
+import os
+
+from psarc import POLICIES, create_psarc_pair, path2dict
+from xml2sng import compile_xmls
+
+SNG_PATH = 'songs/bin/generic/'
+
+
+def compile_sngs(filenames):
+    """Compile a list of XML files to a dictionary SNG name -> binary SNG"""
+    return dict((name, data) for _, name, data in compile_xmls(filenames))
+
+def build_psarcs(xmls, assets, name, policy=None, dedup=False):
+    """Compile the XML files and write NAME_p.psarc and NAME_m.psarc.
+    Assets is a dictionary filepath -> data, in PC or Mac layout. SNG are
+    compiled once and only encrypted for each platform."""
+    files = dict(assets)
+    for sngname, data in compile_sngs(xmls).iteritems():
+        files[SNG_PATH + sngname] = data
+
+    return create_psarc_pair(files, name, policy, dedup)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    assets = {}
+    if args['--assets']:
+        assets = path2dict(os.path.normpath(args['--assets']))
+
+    policy = POLICIES['fast'] if args['--fast'] else None
+    build_psarcs(args['XML'], assets, args['NAME'], policy, args['--dedup'])
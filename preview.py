@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Cut a faded preview clip out of a WAV song.
+
+PCM is streamed from the source in frames of FRAME_COUNT samples, only the
+clip window is read and written, so memory and time do not depend on the
+length of the song.
+
+Usage: preview.py [options] WAV OUTPUT
+
+Options:
+    --start=SEC     Start of the clip in the song. [default: 0]
+    --length=SEC    Length of the clip. [default: 30]
+    --fade=SEC      Length of the fade in and fade out. [default: 1]
+"""
+
+import audioop
+import wave
+
+PREVIEW_START = 0.0
+PREVIEW_LENGTH = 30.0
+PREVIEW_FADE = 1.0
+
+FRAME_COUNT = 4096 # samples read at once
+FADE_STEP = 64     # samples sharing a gain in fades
+
+
+def clip_window(rate, total, start, length):
+    """First sample and sample count of a window in seconds, clamped to the
+    total sample count"""
+    first = min(int(start * rate), total)
+    count = min(int(length * rate), total - first)
+    return first, count
+
+def gain(position, count, fade):
+    """Gain of the sample at position in a clip of count samples, linear
+    fades of fade samples"""
+    if fade <= 0:
+        return 1.0
+    return max(0.0, min(1.0, float(position) / fade,
+                        float(count - position) / fade))
+
+def apply_fade(data, width, frame_size, position, count, fade):
+    """Apply the fades to a frame of PCM data starting at sample position,
+    frame_size being the size of a sample over all the channels"""
+    samples = len(data) // frame_size
+    if fade <= position and position + samples <= count - fade:
+        return data
+
+    output = []
+    for offset in range(0, samples, FADE_STEP):
+        block = data[offset * frame_size:(offset + FADE_STEP) * frame_size]
+        factor = gain(position + offset, count, fade)
+        if factor < 1.0:
+            if width == 1: # 8 bits samples are unsigned
+                block = audioop.bias(block, 1, -128)
+                block = audioop.bias(audioop.mul(block, 1, factor), 1, 128)
+            else:
+                block = audioop.mul(block, width, factor)
+        output.append(block)
+    return ''.join(output)
+
+def write_clip(source, dest, start=PREVIEW_START, length=PREVIEW_LENGTH,
+               fade=PREVIEW_FADE):
+    """Stream a faded clip of a WAV file object to a writable file object.
+    Returns the clip length in seconds."""
+    reader = wave.open(source, 'rb')
+    try:
+        rate = reader.getframerate()
+        width = reader.getsampwidth()
+        first, count = clip_window(rate, reader.getnframes(), start, length)
+        if count <= 0:
+            raise ValueError('clip starts after the end of the song')
+        fade = min(int(fade * rate), count // 2)
+        frame_size = width * reader.getnchannels()
+
+        writer = wave.open(dest, 'wb')
+        try:
+            writer.setparams((reader.getnchannels(), width, rate, count,
+                              'NONE', 'not compressed'))
+            reader.setpos(first)
+            position = 0
+            while position < count:
+                data = reader.readframes(min(FRAME_COUNT, count - position))
+                if not data:
+                    raise IOError('Unexpected end of file')
+                writer.writeframesraw(
+                    apply_fade(data, width, frame_size, position,
+                               count, fade))
+                position += len(data) // frame_size
+        finally:
+            writer.close()
+    finally:
+        reader.close()
+
+    return count / float(rate)
+
+def preview(filename, output, start=PREVIEW_START, length=PREVIEW_LENGTH,
+            fade=PREVIEW_FADE):
+    """Write the faded clip of a WAV file to output"""
+    with open(filename, 'rb') as source:
+        with open(output, 'wb') as dest:
+            return write_clip(source, dest, start, length, fade)
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    preview(args['WAV'], args['OUTPUT'], float(args['--start']),
+            float(args['--length']), float(args['--fade']))
@@ -4,9 +4,44 @@
 Manipulate PSARC archives used by Rocksmith 2014.
 
 Usage:
-    psarc.py pack DIRECTORY...
-    psarc.py unpack FILE...
-    psarc.py convert FILE...
+    psarc.py pack [--dual] [--dedup] [--fast] [--compress=RULES]
+                  [--layout=LAYOUT] [--block-size=SIZE]
+                  [--stats=FILE --profile=DIR --memory] DIRECTORY...
+    psarc.py unpack [--stats=FILE --profile=DIR --memory] FILE...
+    psarc.py convert [--dedup] [--fast] [--compress=RULES]
+                     [--layout=LAYOUT] [--block-size=SIZE]
+                     [--stats=FILE --profile=DIR --memory] FILE...
+    psarc.py merge [--collisions=POLICY] OUTPUT FILE...
+    psarc.py diff OLD NEW
+    psarc.py patch OLD PATCH
+    psarc.py verify [--jobs=N] [--failfast] FILE...
+    psarc.py serve [--host=HOST] [--port=PORT] DIRECTORY
+
+Options:
+    --dual              Write both the PC (_p) and Mac (_m) archives in a
+                        single pass.
+    --dedup             Store identical files once.
+    --fast              Use the fast compression policy, for development.
+    --compress=RULES    Comma separated GLOB:LEVEL rules applied before the
+                        policy ones, LEVEL being 0-9 or store.
+    --layout=LAYOUT     Order of the entry blocks in the archive: grouped,
+                        metadata first and audio last, or sorted, by
+                        reverse file path as the TOC. [default: grouped]
+    --block-size=SIZE   Block size, a power of two from 4096 to 16777216.
+                        The game reads 65536. [default: 65536]
+    --collisions=POLICY Entry kept for a path found in several archives:
+                        first, last or error. [default: error]
+    --host=HOST         Address to serve on. [default: 127.0.0.1]
+    --port=PORT         Port to serve on. [default: 8000]
+    --stats=FILE        Write timers and counters of the run as JSON to
+                        FILE, - for stderr. See stats.py.
+    --profile=DIR       Write a cProfile dump per stage to DIR.
+    --memory            Report the peak memory with --stats.
+    --jobs=N            Number of worker processes, all cores by default.
+    --failfast          Stop at the first damaged archive.
+
+diff writes to stdout a patch holding the blocks of NEW not found in OLD,
+patch writes NEW to stdout.
 """
 
 from Crypto.Cipher import AES
@@ -15,6 +50,16 @@ import zlib
 import os
 import md5
 import sys
+import math
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO
+from fnmatch import fnmatch
+from itertools import izip_longest
+
+import stats
 
 
 MAGIC = "PSAR"
@@ -23,6 +68,18 @@ COMPRESSION = "zlib"
 ARCHIVE_FLAGS = 4
 ENTRY_SIZE = 30
 BLOCK_SIZE = 65536
+MIN_BLOCK_SIZE = 4096
+MAX_BLOCK_SIZE = 256**3
+CACHE_BLOCKS = 64 # decompressed blocks kept by a BlockCache
+COPY_SIZE = 16 * BLOCK_SIZE
+
+PATCH_MAGIC = 'PSDP'
+PATCH_VERSION = 1
+PATCH_HEADER = struct.Struct('>4sL16s16sQ') # magic, version, MD5 of OLD and
+                                            # NEW, size of NEW
+PATCH_OP = struct.Struct('>cQL')            # op, offset in OLD, size
+
+VERIFY_BLOCKS = 64 # blocks checked per task by verify
 
 ARC_KEY = 'C53DB23870A1A2F71CAE64061FDD0E1157309DC85204D4C5BFDF25090DF2572C'
 ARC_IV = 'E915AA018FEF71FC508132E4BB4CEB42'
@@ -30,6 +87,39 @@ ARC_IV = 'E915AA018FEF71FC508132E4BB4CEB42'
 MAC_KEY = '9821330E34B91F70D0A48CBD625993126970CEA09192C0E6CDA676CC9838289D'
 PC_KEY = 'CB648DF3D12A16BF71701414E69619EC171CCA5D2A142E3E59DE7ADDA18A3A30'
 
+# Archive suffix and osx2pc flag for each platform
+PLATFORMS = [('_p', True), ('_m', False)]
+
+# Compression policies. Rules are (glob, level) pairs, the first rule
+# matching the filepath applies. Blocks are written uncompressed with STORE,
+# or when probe is set and they look incompressible.
+STORE = 'store'
+ENTROPY_THRESHOLD = 7.9 # bits per byte
+PROBE_SIZE = 4096
+
+POLICIES = {
+    'best' : {
+        'probe'      : False,
+        'rules'      : [('*', zlib.Z_BEST_COMPRESSION)],
+        'block_size' : BLOCK_SIZE,
+        'layout'     : 'grouped'
+    },
+    'fast' : {
+        'probe'      : True,
+        'rules'      : [('*.wem', STORE), ('*.dds', 1), ('*', 6)],
+        'block_size' : BLOCK_SIZE,
+        'layout'     : 'grouped'
+    }
+}
+
+# Layouts of the entry blocks. Rules are (glob, group) pairs, the first rule
+# matching the filepath applies. Blocks are written by group, in TOC order
+# within a group, the file listing first. The TOC order is left as it is.
+LAYOUTS = {
+    'grouped' : [('*.wem', 2), ('*.dds', 1), ('*', 0)],
+    'sorted'  : []
+}
+
 
 def pad(data, blocksize=16):
     """Zeros padding"""
@@ -47,6 +137,7 @@ def path2dict(path):
             with open(fullpath, 'rb') as fstream:
                 output[name] = fstream.read()
 
+    stats.count('psarc.files_read', len(output))
     return output
 
 def stdout_same_line(line):
@@ -89,10 +180,11 @@ def aes_ctr(data, key, ivector, encrypt=True):
 
     return output
 
-def decrypt_sng(data, key):
+def decrypt_sng(data, key, strict=False):
     """Decrypt SNG. Data consist of a 8 bytes header, 16 bytes initialization
     vector and payload and the DSA signature. Payload is first decrypted using
-    AES CTR and then zlib decompressed. Size is checked."""
+    AES CTR and then zlib decompressed. Size is checked, an invalid SNG
+    raises a ValueError when strict."""
 
     decrypted = aes_ctr(data[24:], key, data[8:24], encrypt=False)
     length = struct.unpack('<L', decrypted[:4])[0] # file size
@@ -101,17 +193,26 @@ def decrypt_sng(data, key):
         payload = zlib.decompress(decrypted[4:])
         assert len(payload) == length
     except:
+        if strict:
+            raise ValueError('Invalid SNG payload')
         print 'An error occurred while processing sng!'
         payload = decrypted
 
     return payload
 
-def encrypt_sng(data, key):
-    """Encrypt SNG"""
-    output = struct.pack('<LL', 0x4a, 3) # the header
-
+def compress_sng(data):
+    """Size prefixed zlib payload of a SNG, ready to be encrypted"""
     payload = struct.pack('<L', len(data))
     payload += zlib.compress(data, zlib.Z_BEST_COMPRESSION)
+    return payload
+
+def encrypt_sng(data, key, payload=None):
+    """Encrypt SNG. A payload from compress_sng can be given to avoid
+    compressing data again."""
+    output = struct.pack('<LL', 0x4a, 3) # the header
+
+    if payload is None:
+        payload = compress_sng(data)
 
     ivector = 16*chr(0)
     output += ivector
@@ -120,8 +221,8 @@ def encrypt_sng(data, key):
     return output + 56 * chr(0)
 
 
-def read_entry(filestream, entry):
-    """Extract zlib for one entry"""
+def read_entry(filestream, entry, strict=False):
+    """Extract zlib for one entry, see decrypt_sng for strict"""
     data = ''
 
     length = entry['length']
@@ -130,57 +231,234 @@ def read_entry(filestream, entry):
 
     i = 0
     while len(data) < length:
-        if zlength[i] == 0:
-            data += filestream.read(BLOCK_SIZE)
-        else:
-            chunk = filestream.read(zlength[i])
-            try:
-                data += zlib.decompress(chunk)
-            except zlib.error:
-                data += chunk
+        data += read_block(filestream, zlength[i], entry['block_size'])
         i += 1
+    stats.count('psarc.blocks_read', i)
+    stats.count('psarc.bytes_read', length)
 
     # Post process for sng
-    if entry['filepath'].find('songs/bin/macos/') > -1:
-        data = decrypt_sng(data, MAC_KEY)
-    elif entry['filepath'].find('songs/bin/generic/') > -1:
-        data = decrypt_sng(data, PC_KEY)
+    key = sng_key(entry['filepath'])
+    if key:
+        data = decrypt_sng(data, key, strict)
+        stats.count('psarc.sng_decrypted')
 
     return data
 
-def create_entry(name, data):
-    """Chunk a file"""
+def read_block(filestream, zsize, block_size=BLOCK_SIZE):
+    """Read and inflate the block at the current position, zsize being its
+    zlength value"""
+    return inflate_block(filestream.read(zsize or block_size), zsize)
+
+def inflate_block(chunk, zsize):
+    """Inflate a block read from the archive"""
+    if zsize == 0:
+        return chunk
+
+    try:
+        return zlib.decompress(chunk)
+    except zlib.error:
+        return chunk
+
+def entry_blocks(entry):
+    """List of (offset, zlength) of the blocks of an entry"""
+    blocks = []
+    offset = entry['offset']
+    block_size = entry['block_size']
+    n_blocks = (entry['length'] + block_size - 1) // block_size
+    for zsize in entry['zlength'][:n_blocks]:
+        blocks.append((offset, zsize))
+        offset += zsize if zsize != 0 else block_size
+    return blocks
+
+def entry_size(entry):
+    """Size of the blocks of an entry in the archive"""
+    if 'data' in entry:
+        return len(entry['data'])
+    return sum(zsize or entry['block_size'] for zsize in entry['zlength'])
+
+class BlockCache(object):
+    """Bounded LRU cache of decompressed blocks, keyed by block offset.
+    A cache is meant to be shared by the entries of one archive. It can be
+    used from several threads, the lock also guards the archive stream."""
+
+    def __init__(self, size=CACHE_BLOCKS):
+        self.size = size
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filestream, offset, zsize, block_size=BLOCK_SIZE):
+        """Decompressed block at offset"""
+        with self.lock:
+            data = self.blocks.pop(offset, None)
+            if data is not None:
+                self.blocks[offset] = data
+                return data
+
+            filestream.seek(offset)
+            chunk = filestream.read(zsize or block_size)
+
+        # Inflate outside of the lock
+        data = inflate_block(chunk, zsize)
+
+        with self.lock:
+            while self.blocks and len(self.blocks) >= self.size:
+                self.blocks.popitem(last=False)
+            self.blocks[offset] = data
+
+        return data
+
+class EntryFile(object):
+    """Seekable read-only file object over an entry. Only the blocks covering
+    the range read are decompressed, through a BlockCache."""
+
+    def __init__(self, filestream, entry, cache=None):
+        self.filestream = filestream
+        self.cache = cache if cache is not None else BlockCache()
+        self.blocks = entry_blocks(entry)
+        self.block_size = entry['block_size']
+        self.length = entry['length']
+        self.position = 0
+
+    def read(self, size=-1):
+        """Read up to size bytes, until the end of the entry by default"""
+        if size < 0 or self.position + size > self.length:
+            size = self.length - self.position
+
+        chunks = []
+        while size > 0:
+            idx, start = divmod(self.position, self.block_size)
+            offset, zsize = self.blocks[idx]
+            block = self.cache.get(self.filestream, offset, zsize,
+                                   self.block_size)
+            chunk = block[start:start + size]
+            if not chunk:
+                break
+            chunks.append(chunk)
+            self.position += len(chunk)
+            size -= len(chunk)
+
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move to offset, relative to whence as for files"""
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = max(0, offset)
+
+    def tell(self):
+        """Current position"""
+        return self.position
+
+    def close(self):
+        """Nothing to release, the archive stream belongs to the caller"""
+        pass
+
+def open_entry(filestream, entry, cache=None):
+    """Seekable file object for an entry. SNG are decrypted as a whole."""
+    if sng_key(entry['filepath']):
+        return StringIO(read_entry(filestream, entry))
+    return EntryFile(filestream, entry, cache)
+
+def sng_key(filepath):
+    """SNG encryption key for a filepath, None if it is not a SNG"""
+    if filepath.find('songs/bin/macos/') > -1:
+        return MAC_KEY
+    elif filepath.find('songs/bin/generic/') > -1:
+        return PC_KEY
+    return None
+
+def parse_rules(rules):
+    """Parse comma separated GLOB:LEVEL compression rules, raises a
+    ValueError if one is malformed"""
+    output = []
+    for rule in rules.split(','):
+        pattern, _, level = rule.rpartition(':')
+        if level != STORE:
+            if not pattern or not level.isdigit() or int(level) > 9:
+                raise ValueError('Invalid compression rule ' + repr(rule))
+            level = int(level)
+        output.append((pattern, level))
+    return output
+
+def compression_level(name, policy):
+    """Compression level of a filepath for a given policy"""
+    for pattern, level in policy['rules']:
+        if fnmatch(name, pattern):
+            return level
+    return zlib.Z_BEST_COMPRESSION
+
+def entropy(data):
+    """Shannon entropy of data in bits per byte"""
+    total = float(len(data))
+    counts = [data.count(chr(c)) for c in xrange(256)]
+    return -sum(c / total * math.log(c / total, 2) for c in counts if c)
+
+def incompressible(raw):
+    """Quick probe on the beginning of a block"""
+    return entropy(raw[:PROBE_SIZE]) > ENTROPY_THRESHOLD
+
+def create_entry(name, data, payload=None, policy=None):
+    """Chunk a file. SNG are encrypted first, see encrypt_sng for payload.
+    Blocks are compressed following policy, the best one by default."""
 
     # Pre process for sng
-    if name.find('songs/bin/macos/') > -1:
-        data = encrypt_sng(data, MAC_KEY)
-    elif name.find('songs/bin/generic/') > -1:
-        data = encrypt_sng(data, PC_KEY)
+    key = sng_key(name)
+    if key:
+        data = encrypt_sng(data, key, payload)
+        stats.count('psarc.sng_encrypted')
+
+    policy = policy or POLICIES['best']
+    level = compression_level(name, policy)
+    block_size = policy['block_size']
 
     zlength = []
     output = ''
+    stored = 0
 
     i = 0
     while i < len(data):
-        raw = data[i:i+BLOCK_SIZE]
-        i += BLOCK_SIZE
+        raw = data[i:i+block_size]
+        i += block_size
+
+        compressed = raw
+        if level != STORE and not (policy['probe'] and incompressible(raw)):
+            compressed = zlib.compress(raw, level)
 
-        compressed = zlib.compress(raw, zlib.Z_BEST_COMPRESSION)
         if len(compressed) < len(raw):
             output += compressed
             zlength.append(len(compressed))
         else:
             output += raw
-            zlength.append(len(raw) % BLOCK_SIZE)
+            zlength.append(len(raw) % block_size)
+            stored += 1
 
+    stats.count('psarc.blocks_written', len(zlength))
+    stats.count('psarc.blocks_stored', stored)
+    stats.count('psarc.bytes_written', len(output))
     return {
-        'filepath' : name,
-        'zlength'  : zlength,
-        'length'   : len(data),
-        'data'     : output,
-        'md5'      : md5.new(name).digest() if name != '' else 16 * chr(0)
+        'filepath'   : name,
+        'zlength'    : zlength,
+        'length'     : len(data),
+        'data'       : output,
+        'block_size' : block_size,
+        'md5'        : md5.new(name).digest() if name != '' else 16 * chr(0)
     }
 
+def valid_block_size(block_size):
+    """Whether a block size can be written, a power of two whose zlength
+    values fit in 3 bytes"""
+    return MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE and \
+        block_size & (block_size - 1) == 0
+
+def zlength_width(block_size):
+    """Bytes of a zlength value in the TOC, 2 for the usual block size"""
+    width = 2
+    while 256**width < block_size:
+        width += 1
+    return width
+
 
 def cipher_toc():
     """AES CFB Mode"""
@@ -191,9 +469,9 @@ def cipher_toc():
         segment_size=128
     )
 
-def read_toc(filestream):
-    """Read entry list and Z-fragments.
-    Returns a list of entries to be used with read_entry."""
+def read_toc_entries(filestream):
+    """Read entry list and Z-fragments. Returns all the entries, the file
+    listing first, without their file paths."""
 
     entries = []
     zlength = []
@@ -203,6 +481,10 @@ def read_toc(filestream):
 
     toc_size = header[3] - 32
     n_entries = header[5]
+    block_size = header[6]
+    if not valid_block_size(block_size):
+        raise ValueError('Unsupported block size {0}'.format(block_size))
+    width = zlength_width(block_size)
 
     toc = cipher_toc().decrypt(pad(filestream.read(toc_size)))
     toc_position = 0
@@ -211,52 +493,113 @@ def read_toc(filestream):
     while idx < n_entries:
         data = toc[toc_position:toc_position + ENTRY_SIZE]
         entries.append({
-            'md5'    : data[:16],
-            'zindex' : struct.unpack('>L', data[16:20])[0],
-            'length' : struct.unpack('>Q', 3*chr(0) + data[20:25])[0],
-            'offset' : struct.unpack('>Q', 3*chr(0) + data[25:])[0]
+            'md5'        : data[:16],
+            'zindex'     : struct.unpack('>L', data[16:20])[0],
+            'length'     : struct.unpack('>Q', 3*chr(0) + data[20:25])[0],
+            'offset'     : struct.unpack('>Q', 3*chr(0) + data[25:])[0],
+            'block_size' : block_size
         })
         toc_position += ENTRY_SIZE
         idx += 1
 
     idx = 0
-    while idx < (toc_size - ENTRY_SIZE * n_entries) / 2:
-        data = toc[toc_position:toc_position + 2]
-        zlength.append(struct.unpack('>H', data)[0])
-        toc_position += 2
+    while idx < (toc_size - ENTRY_SIZE * n_entries) / width:
+        data = toc[toc_position:toc_position + width]
+        zlength.append(struct.unpack('>L', (4 - width)*chr(0) + data)[0])
+        toc_position += width
         idx += 1
 
     for entry in entries:
         entry['zlength'] = zlength[entry['zindex']:]
 
+    return entries
+
+def read_toc(filestream):
+    """Read entry list and Z-fragments.
+    Returns a list of entries to be used with read_entry."""
+
+    entries = read_toc_entries(filestream)
+
     # Process the first entry as it contains the file listing
     entries[0]['filepath'] = ''
     filepaths = read_entry(filestream, entries[0]).split()
     for entry, filepath in zip(entries[1:], filepaths):
         entry['filepath'] = filepath
 
+    stats.count('psarc.entries_listed', len(entries) - 1)
     return entries[1:]
 
+class Archive(object):
+    """An open PSARC. The TOC is read once and decompressed blocks are
+    shared by all the entries opened through one BlockCache."""
+
+    def __init__(self, filename, cache_blocks=CACHE_BLOCKS):
+        self.filename = filename
+        self.filestream = open(filename, 'rb')
+        self.entries = read_toc(self.filestream)
+        self.index = dict((e['filepath'], e) for e in self.entries)
+        self.cache = BlockCache(cache_blocks)
+
+    def open(self, filepath):
+        """Seekable file object for an entry"""
+        with self.cache.lock:
+            return open_entry(self.filestream, self.index[filepath], self.cache)
+
+    def read(self, filepath):
+        """Whole content of an entry"""
+        return self.open(filepath).read()
+
+    def close(self):
+        """Close the archive"""
+        self.filestream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
 def create_toc(entries):
-    """Build an encrypted TOC for a given list of entries."""
+    """Build an encrypted TOC for a given list of entries. Blocks are laid
+    out in layout_order."""
+
+    block_size = entries[0]['block_size']
+    if any(entry['block_size'] != block_size for entry in entries):
+        raise ValueError('Entries of different block sizes')
+    width = zlength_width(block_size)
 
     offset = 0
     zindex = 0
     zlength = []
-    for entry in entries:
+    shared = {}
+    duplicates = 0
+    for entry in layout_order(entries):
+        # Deduplicated entries point at the blocks of the first copy
+        digest = entry.get('digest')
+        entry['duplicate'] = digest in shared
+        if entry['duplicate']:
+            entry['offset'], entry['zindex'] = shared[digest]
+            duplicates += 1
+            continue
+
         entry['offset'] = offset
-        offset += len(entry['data'])
+        offset += entry_size(entry)
 
         entry['zindex'] = zindex
         zindex += len(entry['zlength'])
 
         zlength += entry['zlength']
 
+        if digest is not None:
+            shared[digest] = entry['offset'], entry['zindex']
+
+    stats.count('psarc.entries_written', len(entries))
+    stats.count('psarc.duplicate_entries', duplicates)
 
-    toc_size = 32 + ENTRY_SIZE * len(entries) + 2 * len(zlength)
+    toc_size = 32 + ENTRY_SIZE * len(entries) + width * len(zlength)
 
     header = struct.pack('>4sL4sLLLLL', MAGIC, VERSION, COMPRESSION,
-                toc_size, ENTRY_SIZE, len(entries), BLOCK_SIZE, ARCHIVE_FLAGS)
+                toc_size, ENTRY_SIZE, len(entries), block_size, ARCHIVE_FLAGS)
 
     toc = ''
     for entry in entries:
@@ -266,16 +609,17 @@ def create_toc(entries):
         toc += struct.pack('>Q', entry['offset'] + toc_size)[-5:]
 
     for i in zlength:
-        toc += struct.pack('>H', i)
+        toc += struct.pack('>L', i)[-width:]
 
     # the [:toc_size] seems a little odd, but padding is not applied
     # in official PSARC either
     return (header + cipher_toc().encrypt(pad(toc)))[:toc_size]
 
 
-def extract_psarc(filename):
-    """Extract a PSARC to disk"""
-    basepath = os.path.basename(filename)[:-6]
+def extract_psarc(filename, outdir='', strict=False):
+    """Extract a PSARC to disk, in outdir. Returns the extracted directory.
+    See decrypt_sng for strict."""
+    basepath = os.path.join(outdir, os.path.basename(filename)[:-6])
 
     with open(filename, 'rb') as psarc:
         entries = read_toc(psarc)
@@ -284,7 +628,7 @@ def extract_psarc(filename):
         for idx, entry in enumerate(entries):
             stdout_same_line(logmsg.format(idx+1))
             fname = os.path.join(basepath, entry['filepath'])
-            data = read_entry(psarc, entry)
+            data = read_entry(psarc, entry, strict)
 
             path = os.path.dirname(fname)
             if not os.path.exists(path):
@@ -293,23 +637,492 @@ def extract_psarc(filename):
                 fstream.write(data)
     print
 
-def create_psarc(files, filename):
-    """Writes a dictionary filepath -> data to a PSARC file"""
+    return basepath
+
+def archive_entries(entries, policy=None):
+    """Ordered entry list of an archive from a dictionary filepath -> entry.
+    The first entry is the file listing. Entries are copied as create_toc
+    sets their offsets, so that an entry can be shared between archives.
+    Their layout group is set following the policy."""
+    policy = policy or POLICIES['best']
+    rules = LAYOUTS[policy['layout']]
+
     # Order is reversed
-    filenames = reversed(sorted(files.keys()))
-    entries = [create_entry('', '\n'.join(filenames))]
+    filenames = list(reversed(sorted(entries.keys())))
+    output = [dict(create_entry('', '\n'.join(filenames), policy=policy),
+                   group=-1)]
+    for name in filenames:
+        group = next((g for pattern, g in rules if fnmatch(name, pattern)), 0)
+        output.append(dict(entries[name], group=group))
+    return output
+
+def layout_order(entries):
+    """Entries of archive_entries in the order their blocks are written"""
+    return sorted(entries, key=lambda entry: entry['group'])
+
+def write_entry(fstream, entry):
+    """Write the blocks of an entry, copied from its source archive for
+    entries of source_entry"""
+    if 'data' in entry:
+        fstream.write(entry['data'])
+        return
+
+    source, offset = entry['source']
+    source.seek(offset)
+    size = entry_size(entry)
+    while size > 0:
+        chunk = source.read(min(size, COPY_SIZE))
+        if not chunk:
+            raise IOError('Unexpected end of file')
+        fstream.write(chunk)
+        size -= len(chunk)
+
+def write_psarcs(archives):
+    """Stream out several archives together from a list of
+    (filename, entries) pairs, entries being ordered by archive_entries"""
+    streams = [open(filename, 'wb') for filename, _ in archives]
+    try:
+        for fstream, (_, entries) in zip(streams, archives):
+            fstream.write(create_toc(entries))
+
+        for row in izip_longest(*[layout_order(entries)
+                                  for _, entries in archives]):
+            for fstream, entry in zip(streams, row):
+                if entry is not None and not entry['duplicate']:
+                    write_entry(fstream, entry)
+    finally:
+        for fstream in streams:
+            fstream.close()
+
+def dedup_entry(name, data, blocks, payload=None, policy=None):
+    """create_entry, unless an entry of identical content is in blocks, a
+    dictionary digest -> entry. The returned entry then shares its blocks."""
+    digest = md5.new(data).digest() + (sng_key(name) or '')
+    if digest in blocks:
+        return dict(blocks[digest], filepath=name, md5=md5.new(name).digest())
+
+    entry = create_entry(name, data, payload, policy)
+    entry['digest'] = digest
+    blocks[digest] = entry
+    return entry
+
+def create_psarc(files, filename, policy=None, dedup=False):
+    """Writes a dictionary filepath -> data to a PSARC file. With dedup,
+    identical files are stored once."""
+    entries = {}
+    blocks = {}
 
     logmsg = 'Creating ' + filename + ' {0}/' + str(len(files))
     for idx, (name, data) in enumerate(reversed(sorted(files.items()))):
         stdout_same_line(logmsg.format(idx+1))
-        entries.append(create_entry(name, data))
+        if dedup:
+            entries[name] = dedup_entry(name, data, blocks, policy=policy)
+        else:
+            entries[name] = create_entry(name, data, policy=policy)
 
-    with open(filename, 'wb') as fstream:
-        fstream.write(create_toc(entries))
-        for entry in entries:
-            fstream.write(entry['data'])
+    write_psarcs([(filename, archive_entries(entries, policy))])
+    print
+
+def source_entry(filestream, entry):
+    """Entry of an open archive, from read_toc, whose blocks are copied as
+    they are when written. Entries sharing blocks in the archive still share
+    them once written."""
+    block_size = entry['block_size']
+    n_blocks = (entry['length'] + block_size - 1) // block_size
+    return {
+        'filepath'   : entry['filepath'],
+        'zlength'    : entry['zlength'][:n_blocks],
+        'length'     : entry['length'],
+        'md5'        : entry['md5'],
+        'block_size' : block_size,
+        'source'     : (filestream, entry['offset']),
+        'digest'     : (filestream.name, entry['offset'], entry['length'])
+    }
+
+def merge_psarcs(filenames, output, collisions='error'):
+    """Merge PSARC files into output without decompressing them. The entry
+    kept for a path found in several archives is the first or last one
+    following collisions, 'error' raises a ValueError, as archives of
+    different block sizes do."""
+    if collisions not in ('first', 'last', 'error'):
+        raise ValueError('Unknown collision policy ' + collisions)
+    if os.path.abspath(output) in [os.path.abspath(f) for f in filenames]:
+        raise ValueError(output + ' is also an input')
+
+    streams = []
+    entries = {}
+    block_sizes = set()
+    try:
+        logmsg = 'Merging ' + output + ' {0}/' + str(len(filenames))
+        for idx, filename in enumerate(filenames):
+            stdout_same_line(logmsg.format(idx+1))
+            fstream = open(filename, 'rb')
+            streams.append(fstream)
+
+            for entry in read_toc(fstream):
+                block_sizes.add(entry['block_size'])
+                name = entry['filepath']
+                if name in entries:
+                    if collisions == 'error':
+                        raise ValueError('{0} found in {1} and {2}'.format(
+                            name, entries[name]['source'][0].name, filename))
+                    if collisions == 'first':
+                        continue
+                entries[name] = source_entry(fstream, entry)
+
+        if len(block_sizes) > 1:
+            raise ValueError('Archives of different block sizes')
+        policy = dict(POLICIES['best'], block_size=(block_sizes or
+                                                    set([BLOCK_SIZE])).pop())
+        write_psarcs([(output, archive_entries(entries, policy))])
+    finally:
+        for fstream in streams:
+            fstream.close()
     print
 
+def file_md5(fstream):
+    """MD5 of a whole file"""
+    digest = md5.new()
+    fstream.seek(0)
+    for chunk in iter(lambda: fstream.read(COPY_SIZE), ''):
+        digest.update(chunk)
+    return digest.digest()
+
+def block_ranges(filestream):
+    """Sorted list of the distinct (offset, size) of the blocks of all the
+    entries of an archive, the file listing included"""
+    ranges = set()
+    for entry in read_toc_entries(filestream):
+        for offset, zsize in entry_blocks(entry):
+            ranges.add((offset, zsize or entry['block_size']))
+    return sorted(ranges)
+
+def index_blocks(filestream):
+    """Dictionary (size, MD5) -> offset of the blocks of an archive"""
+    index = {}
+    for offset, size in block_ranges(filestream):
+        filestream.seek(offset)
+        key = (size, md5.new(filestream.read(size)).digest())
+        index.setdefault(key, offset)
+    return index
+
+class PatchWriter(object):
+    """Write patch operations, merging contiguous copies and inserts"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.copy = None
+        self.insert = []
+        self.insert_size = 0
+
+    def add_copy(self, offset, size):
+        """Copy size bytes of OLD at offset"""
+        self.flush_insert()
+        if self.copy and sum(self.copy) == offset:
+            self.copy[1] += size
+        else:
+            self.flush_copy()
+            self.copy = [offset, size]
+
+    def add_insert(self, data):
+        """Insert data"""
+        self.flush_copy()
+        self.insert.append(data)
+        self.insert_size += len(data)
+        if self.insert_size >= COPY_SIZE:
+            self.flush_insert()
+
+    def flush_copy(self):
+        """Write the pending copy"""
+        if self.copy:
+            self.stream.write(PATCH_OP.pack('C', *self.copy))
+            self.copy = None
+
+    def flush_insert(self):
+        """Write the pending insert"""
+        if self.insert:
+            self.stream.write(PATCH_OP.pack('I', 0, self.insert_size))
+            for data in self.insert:
+                self.stream.write(data)
+            self.insert = []
+            self.insert_size = 0
+
+    def close(self):
+        """Write the pending operation and the end marker"""
+        self.flush_copy()
+        self.flush_insert()
+        self.stream.write(PATCH_OP.pack('E', 0, 0))
+
+def diff_psarc(old, new, output):
+    """Write to the output stream a patch turning the archive old into new.
+    The blocks of new are looked up in old by content, the TOC and the
+    blocks missing from old are stored in the patch."""
+    with open(old, 'rb') as old_stream:
+        with open(new, 'rb') as new_stream:
+            index = index_blocks(old_stream)
+            new_size = os.fstat(new_stream.fileno()).st_size
+            output.write(PATCH_HEADER.pack(PATCH_MAGIC, PATCH_VERSION,
+                                           file_md5(old_stream),
+                                           file_md5(new_stream), new_size))
+
+            writer = PatchWriter(output)
+            position = 0
+            for offset, size in block_ranges(new_stream) + [(new_size, 0)]:
+                if offset + size <= position:
+                    continue
+                offset = max(offset, position)
+
+                # TOC and any bytes out of blocks
+                new_stream.seek(position)
+                while position < offset:
+                    chunk = new_stream.read(min(offset - position, COPY_SIZE))
+                    if not chunk:
+                        raise IOError('Unexpected end of file')
+                    writer.add_insert(chunk)
+                    position += len(chunk)
+
+                chunk = new_stream.read(size)
+                key = (len(chunk), md5.new(chunk).digest())
+                if key in index:
+                    writer.add_copy(index[key], len(chunk))
+                elif chunk:
+                    writer.add_insert(chunk)
+                position += len(chunk)
+            writer.close()
+
+def patch_psarc(old, patch, output):
+    """Write to the output stream the archive rebuilt from the archive old
+    and a patch of diff_psarc. The archive is rebuilt in a temporary file
+    and written only once checked. Raises a ValueError if old is not the
+    archive the patch was made from or if the result does not match."""
+    with open(old, 'rb') as old_stream, open(patch, 'rb') as patch_stream, \
+            tempfile.TemporaryFile() as rebuilt:
+        header = patch_stream.read(PATCH_HEADER.size)
+        if len(header) != PATCH_HEADER.size:
+            raise ValueError(patch + ' is not a PSARC patch')
+        magic, version, old_md5, new_md5, new_size = \
+            PATCH_HEADER.unpack(header)
+        if magic != PATCH_MAGIC or version != PATCH_VERSION:
+            raise ValueError(patch + ' is not a PSARC patch')
+        if file_md5(old_stream) != old_md5:
+            raise ValueError(old + ' is not the archive the patch is for')
+
+        digest = md5.new()
+        written = 0
+        while True:
+            record = patch_stream.read(PATCH_OP.size)
+            if len(record) != PATCH_OP.size:
+                raise ValueError('Unexpected end of file')
+            op, offset, size = PATCH_OP.unpack(record)
+            if op == 'E':
+                break
+            source = patch_stream
+            if op == 'C':
+                source = old_stream
+                old_stream.seek(offset)
+            while size > 0:
+                chunk = source.read(min(size, COPY_SIZE))
+                if not chunk:
+                    raise ValueError('Unexpected end of file')
+                digest.update(chunk)
+                rebuilt.write(chunk)
+                written += len(chunk)
+                size -= len(chunk)
+
+        if written != new_size or digest.digest() != new_md5:
+            raise ValueError('Patched archive does not match, not written')
+
+        rebuilt.seek(0)
+        shutil.copyfileobj(rebuilt, output, COPY_SIZE)
+
+def expected_blocks(entry):
+    """List of (offset, stored, size) of the blocks of an entry, stored being
+    the size of the block in the archive and size its inflated size"""
+    block_size = entry['block_size']
+    return [(offset, zsize or block_size,
+             min(block_size, entry['length'] - idx*block_size))
+            for idx, (offset, zsize) in enumerate(entry_blocks(entry))]
+
+def check_block(chunk, stored, size):
+    """Inflate a block read from the archive, raises a ValueError if it is
+    damaged. As written by create_entry, a block is stored raw when
+    compressing does not make it smaller."""
+    if len(chunk) < stored:
+        raise ValueError('truncated block')
+    if stored > size:
+        raise ValueError('block of {0} bytes holding {1} bytes'.format(
+                            stored, size))
+    if stored == size:
+        return chunk
+
+    try:
+        data = zlib.decompress(chunk)
+    except zlib.error as exc:
+        raise ValueError(str(exc))
+    if len(data) != size:
+        raise ValueError('block inflated to {0} bytes instead of {1}'.format(
+                            len(data), size))
+    return data
+
+def read_checked(filestream, blocks):
+    """Read and check blocks of expected_blocks, returns the data"""
+    data = []
+    for offset, stored, size in blocks:
+        filestream.seek(offset)
+        try:
+            data.append(check_block(filestream.read(stored), stored, size))
+        except ValueError as exc:
+            raise ValueError('block at {0}: {1}'.format(offset, exc))
+    return ''.join(data)
+
+def verify_toc(filename):
+    """Check the header, TOC, file listing and path MD5 of an archive.
+    Returns a list of (filepath, error) and the block checks left, as tasks
+    for verify_task."""
+    try:
+        filestream = open(filename, 'rb')
+    except IOError as exc:
+        return [('', exc.strerror)], []
+
+    errors = []
+    tasks = []
+    with filestream:
+        file_size = os.fstat(filestream.fileno()).st_size
+        header = struct.unpack('>4sL4sLLLLL', filestream.read(32).ljust(32))
+        if header[0] != MAGIC or header[2] != COMPRESSION or \
+                header[4] != ENTRY_SIZE or not valid_block_size(header[6]):
+            return [('', 'unsupported header')], []
+
+        try:
+            entries = read_toc_entries(filestream)
+            listing = read_checked(filestream, expected_blocks(entries[0]))
+        except (ValueError, IndexError, struct.error) as exc:
+            return [('', 'TOC or file listing: {0}'.format(exc))], []
+
+        filepaths = listing.split()
+        if len(filepaths) != len(entries) - 1:
+            errors.append(('', 'file listing of {0} paths for {1} '
+                               'entries'.format(len(filepaths),
+                                                len(entries) - 1)))
+
+        for entry, filepath in zip(entries[1:], filepaths):
+            blocks = expected_blocks(entry)
+            n_blocks = (entry['length'] + header[6] - 1) // header[6]
+            end = sum(stored for _, stored, _ in blocks)
+            if entry['md5'] != md5.new(filepath).digest():
+                errors.append((filepath, 'path MD5 mismatch'))
+            if len(blocks) != n_blocks:
+                errors.append((filepath, 'zlength table too short'))
+            elif blocks and blocks[0][0] + end > file_size:
+                errors.append((filepath, 'blocks past the end of the file'))
+            elif sng_key(filepath):
+                tasks.append((filename, filepath, blocks, sng_key(filepath)))
+            else:
+                for i in xrange(0, len(blocks), VERIFY_BLOCKS):
+                    tasks.append((filename, filepath,
+                                  blocks[i:i+VERIFY_BLOCKS], None))
+
+    return errors, tasks
+
+def verify_task(task):
+    """Check blocks of an entry, decrypting SNG. Returns the archive, the
+    filepath and an error message, None if fine."""
+    filename, filepath, blocks, key = task
+    try:
+        with open(filename, 'rb') as filestream:
+            data = read_checked(filestream, blocks)
+        if key:
+            decrypt_sng(data, key, strict=True)
+    except ValueError as exc:
+        return filename, filepath, str(exc)
+    except struct.error:
+        return filename, filepath, 'truncated SNG'
+    return filename, filepath, None
+
+def verify_psarcs(filenames, jobs=None, failfast=False):
+    """Check archives, printing their damaged entries. Blocks are checked
+    across a process pool. Returns the list of damaged archives."""
+    from multiprocessing import Pool
+
+    damaged = set()
+    def report(filename, filepath, error):
+        """Print an error, returns True to stop"""
+        print '{0}: {1}{2}'.format(filename,
+                                   filepath + ': ' if filepath else '', error)
+        sys.stdout.flush()
+        damaged.add(filename)
+        return failfast
+
+    pool = Pool(jobs)
+    try:
+        tasks = []
+        for filename, (errors, checks) in zip(filenames,
+                                              pool.imap(verify_toc, filenames)):
+            for filepath, error in errors:
+                if report(filename, filepath, error):
+                    return sorted(damaged)
+            tasks += checks
+
+        for filename, filepath, error in pool.imap_unordered(verify_task,
+                                                             tasks):
+            if error and report(filename, filepath, error):
+                return sorted(damaged)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for filename in filenames:
+        if filename not in damaged:
+            print '{0}: OK'.format(filename)
+    return sorted(damaged)
+
+def create_psarc_pair(files, basename, policy=None, dedup=False):
+    """Writes a dictionary filepath -> data, in PC or Mac layout, to both
+    basename_p.psarc and basename_m.psarc. Files of identical data on both
+    platforms, audio under its platform paths included, are compressed once,
+    SNG payloads are compressed once and encrypted for each platform."""
+    policy = policy or POLICIES['best']
+    entries = dict((osx2pc, {}) for _, osx2pc in PLATFORMS)
+    blocks = {}
+
+    def build(filepath, data, payload=None):
+        """Create an entry, deduplicated if asked"""
+        if dedup:
+            return dedup_entry(filepath, data, blocks, payload, policy)
+        return create_entry(filepath, data, payload, policy)
+
+    logmsg = 'Creating ' + basename + ' {0}/' + str(len(files))
+    for idx, (name, data) in enumerate(reversed(sorted(files.items()))):
+        stdout_same_line(logmsg.format(idx+1))
+
+        converted = [platform_entry(name, data, osx2pc) + (osx2pc,)
+                        for _, osx2pc in PLATFORMS]
+
+        # Identical data, even under platform paths, is compressed once and
+        # each platform gets a copy of the entry under its own path
+        filepath, platform_data, _ = converted[0]
+        level = compression_level(filepath, policy)
+        if not sng_key(filepath) and \
+                all(c[1] == platform_data and
+                    compression_level(c[0], policy) == level
+                    for c in converted):
+            entry = build(filepath, platform_data)
+            for filepath, _, osx2pc in converted:
+                entries[osx2pc][filepath] = dict(entry, filepath=filepath,
+                                                 md5=md5.new(filepath).digest())
+            continue
+
+        payload = compress_sng(data) if sng_key(name) else None
+        for filepath, platform_data, osx2pc in converted:
+            entries[osx2pc][filepath] = build(filepath, platform_data, payload)
+
+    outputs = [basename + suffix + '.psarc' for suffix, _ in PLATFORMS]
+    write_psarcs([(filename, archive_entries(entries[osx2pc], policy))
+                    for filename, (_, osx2pc) in zip(outputs, PLATFORMS)])
+    print
+
+    return outputs
+
 def change_path(data, osx2pc):
     """Changing path"""
     if osx2pc:
@@ -320,46 +1133,123 @@ def change_path(data, osx2pc):
         data = data.replace('bin/generic', 'bin/macos')
     return data
 
-def convert(filename):
-    """Convert between PC and Mac PSARC"""
+def platform_entry(filepath, data, osx2pc):
+    """Move an entry to the PC (osx2pc) or Mac layout.
+    Returns the new filepath and data."""
+    if filepath.endswith('aggregategraph.nt'):
+        data = change_path(data, osx2pc)
+        if osx2pc:
+            data = data.replace('macos', 'dx9')
+        else:
+            data = data.replace('dx9', 'macos')
 
-    content = {}
+    return change_path(filepath, osx2pc), data
 
-    osx2pc = False
-    outname = filename
+def converted_name(filename, outdir=None):
+    """Name of the archive converted from a _m or _p archive, next to it or
+    in outdir"""
     if filename.endswith('_m.psarc'):
-        outname = filename.replace('_m.psarc', '_p.psarc')
-        osx2pc = True
+        outname = filename[:-len('_m.psarc')] + '_p.psarc'
     else:
-        outname = filename.replace('_p.psarc', '_m.psarc')
+        outname = filename[:-len('_p.psarc')] + '_m.psarc'
+    if outdir is not None:
+        outname = os.path.join(outdir, os.path.basename(outname))
+    return outname
+
+def convert(filename, policy=None, dedup=False, strict=False, outdir=None):
+    """Convert between PC and Mac PSARC, next to filename or in outdir.
+    Returns the converted file name. See decrypt_sng for strict."""
+
+    content = {}
+    osx2pc = filename.endswith('_m.psarc')
+    outname = converted_name(filename, outdir)
 
     with open(filename, 'rb') as psarc:
         entries = read_toc(psarc)
         for entry in entries:
-            data = read_entry(psarc, entry)
-
-            if entry['filepath'].endswith('aggregategraph.nt'):
-                data = change_path(data, osx2pc)
-                if osx2pc:
-                    data = data.replace('macos', 'dx9')
-                else:
-                    data = data.replace('dx9', 'macos')
-
-            content[change_path(entry['filepath'], osx2pc)] = data
-
-    create_psarc(content, outname)
-
-if __name__ == '__main__':
-    from docopt import docopt
-    args = docopt(__doc__)
-
+            data = read_entry(psarc, entry, strict)
+            filepath, data = platform_entry(entry['filepath'], data, osx2pc)
+            content[filepath] = data
+
+    create_psarc(content, outname, policy, dedup)
+
+    return outname
+
+def args_policy(args):
+    """Compression policy from command line options, raises a ValueError if
+    one is invalid"""
+    policy = dict(POLICIES['fast' if args['--fast'] else 'best'])
+    if args['--compress']:
+        policy['rules'] = parse_rules(args['--compress']) + policy['rules']
+    if args['--layout'] not in LAYOUTS:
+        raise ValueError('Unknown layout ' + repr(args['--layout']))
+    policy['layout'] = args['--layout']
+    size = args['--block-size']
+    if not size.isdigit() or not valid_block_size(int(size)):
+        raise ValueError('Invalid block size ' + repr(size))
+    policy['block_size'] = int(size)
+    return policy
+
+def main(argv=None):
+    """Command line, returns the exit status"""
+    from docopt import docopt, DocoptExit
+    args = docopt(__doc__, argv)
+
+    policy = None
+    if args['pack'] or args['convert']:
+        try:
+            policy = args_policy(args)
+        except ValueError as exc:
+            raise DocoptExit(str(exc))
+
+    with stats.session(sys.modules[__name__], args['--stats'],
+                       args['--profile'], args['--memory']):
+        return run_command(args, policy)
+
+def run_command(args, policy=None):
+    """Run the command of parsed arguments, policy being the compression
+    policy of pack and convert. Returns the exit status."""
     if args['unpack']:
         for f in args['FILE']:
             extract_psarc(f)
     elif args['pack']:
         for d in args['DIRECTORY']:
             d = os.path.normpath(d)
-            create_psarc(path2dict(d), d + '.psarc')
+            if args['--dual']:
+                create_psarc_pair(path2dict(d), d, policy, args['--dedup'])
+            else:
+                create_psarc(path2dict(d), d + '.psarc', policy,
+                             args['--dedup'])
     elif args['convert']:
         for f in args['FILE']:
-            convert(f)
+            convert(f, policy, args['--dedup'])
+    elif args['merge']:
+        try:
+            merge_psarcs(args['FILE'], args['OUTPUT'], args['--collisions'])
+        except ValueError as exc:
+            print
+            print exc
+            return 1
+    elif args['diff']:
+        diff_psarc(args['OLD'], args['NEW'], sys.stdout)
+    elif args['patch']:
+        try:
+            patch_psarc(args['OLD'], args['PATCH'], sys.stdout)
+        except ValueError as exc:
+            sys.stderr.write(str(exc) + '\n')
+            return 1
+    elif args['verify']:
+        jobs = int(args['--jobs']) if args['--jobs'] else None
+        damaged = verify_psarcs(args['FILE'], jobs, args['--failfast'])
+        if damaged:
+            print '{0}/{1} archives damaged'.format(len(damaged),
+                                                    len(args['FILE']))
+            return 1
+    elif args['serve']:
+        from psarcserver import serve
+        serve(args['DIRECTORY'][0], args['--host'], int(args['--port']))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+Serve the entries of a library of PSARC archives over local HTTP.
+
+Archives are opened once, their decrypted TOC and a block cache are kept in
+memory. Entries are served at /<archive>/<filepath>, <archive> being the
+path of the archive in the library directory without the .psarc extension,
+as dlc/song_p. / lists the archives and /<archive>/ the entries of an
+archive, as JSON. Archives that cannot be read are reported and skipped.
+
+Requests are handled by threads: decompression happens in the thread of the
+request, entries are streamed block by block and single byte ranges are
+supported.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import json
+import mimetypes
+import os
+import re
+import sys
+import urllib
+
+from psarc import Archive, BLOCK_SIZE
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def load_library(directory):
+    """Open all the PSARC of a directory tree, skipping those that cannot
+    be read. Returns a dictionary archive name -> Archive, the name being the
+    path relative to directory without extension."""
+    library = {}
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if not filename.endswith('.psarc'):
+                continue
+            fullpath = os.path.join(dirpath, filename)
+            name = os.path.relpath(fullpath, directory)[:-6]
+            try:
+                library[name.replace(os.sep, '/')] = Archive(fullpath)
+            except Exception as exc:
+                sys.stderr.write('Skipping {0}: {1}: {2}\n'.format(
+                                    fullpath, type(exc).__name__, exc))
+    return library
+
+def split_path(library, path):
+    """Archive name and entry file path of a request path, the longest
+    archive name matching. The name is None if no archive matches."""
+    parts = path.split('/')
+    for i in range(len(parts), 0, -1):
+        name = '/'.join(parts[:i])
+        if name in library:
+            return name, '/'.join(parts[i:])
+    return None, path
+
+def parse_range(header, length):
+    """Start and end (excluded) of a single bytes range, None when the
+    range cannot be satisfied"""
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if start == '':
+        start, end = max(0, length - int(end)), length
+    else:
+        start = int(start)
+        end = min(int(end) + 1, length) if end != '' else length
+
+    if start >= end:
+        return None
+    return start, end
+
+
+class EntryHandler(BaseHTTPRequestHandler):
+    """GET and HEAD handler for archive entries"""
+
+    def do_HEAD(self):
+        self.serve(body=False)
+
+    def do_GET(self):
+        self.serve(body=True)
+
+    def serve(self, body):
+        """Dispatch on the request path"""
+        library = self.server.library
+        path = urllib.unquote(self.path.split('?', 1)[0]).lstrip('/')
+        if path == '':
+            return self.send_json(sorted(library.keys()), body)
+
+        name, filepath = split_path(library, path)
+        if name is None:
+            return self.send_error(404)
+
+        archive = library[name]
+        if filepath == '':
+            return self.send_json(sorted(archive.index.keys()), body)
+        if filepath not in archive.index:
+            return self.send_error(404)
+
+        self.send_entry(archive, filepath, body)
+
+    def send_json(self, content, body):
+        """Send a JSON document"""
+        data = json.dumps(content)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def send_entry(self, archive, filepath, body):
+        """Stream an entry, or a range of it, block by block"""
+        entry = archive.open(filepath)
+        entry.seek(0, os.SEEK_END)
+        length = entry.tell()
+
+        start, end = 0, length
+        if self.headers.getheader('Range'):
+            byterange = parse_range(self.headers.getheader('Range'), length)
+            if byterange is None:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % length)
+                self.end_headers()
+                return
+            start, end = byterange
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end - 1, length))
+        else:
+            self.send_response(200)
+
+        mimetype = mimetypes.guess_type(filepath)[0]
+        self.send_header('Content-Type', mimetype or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        if not body:
+            return
+
+        entry.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = entry.read(min(BLOCK_SIZE, remaining))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    def log_message(self, *_):
+        pass
+
+class LibraryServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in its own thread"""
+    daemon_threads = True
+
+    def __init__(self, address, library):
+        HTTPServer.__init__(self, address, EntryHandler)
+        self.library = library
+
+
+def serve(directory, host='127.0.0.1', port=8000):
+    """Serve a directory of PSARC until interrupted"""
+    library = load_library(directory)
+    server = LibraryServer((host, port), library)
+    print 'Serving {0} archives on http://{1}:{2}/'.format(len(library),
+                                                            host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for archive in library.values():
+            archive.close()
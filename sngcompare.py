@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+"""
+Compile a corpus of Rocksmith XML with a reference and a candidate xml2sng.py
+and check that the SNG are byte identical.
+
+REFERENCE and CANDIDATE are directories holding an xml2sng.py and its
+sngparser.py, a git worktree of the reference revision for instance. Each
+implementation is imported in its own process pool and both compile at
+once. PATH is an XML file, a glob or a directory searched for *.xml.
+
+When the SNG differ, both are decoded with sngparser and the fields that
+differ are reported by path, as levels[3].notes[120].mask. With --cache,
+reference SNG are kept by XML content and reference sources, so that only
+the candidate compiles on the next runs.
+
+With --joint, the candidate also compiles the arrangements of each song
+together through compile_xmls, sharing their song timing, and that SNG is
+compared to the reference as well. The arrangements of a song are the XML of
+a directory with the same name before the last underscore, as mysong_lead.xml
+and mysong_bass.xml.
+
+Usage: sngcompare.py [options] REFERENCE CANDIDATE PATH...
+
+Options:
+    --jobs=N        Worker processes per implementation, half the cores by
+                    default.
+    --cache=DIR     Directory of the reference SNG cache.
+    --fields=N      Differing fields reported per XML. [default: 10]
+    --joint         Also compile the arrangements of each song together.
+"""
+
+from multiprocessing import Pool, cpu_count
+from timeit import default_timer as timer
+import Queue
+import fnmatch
+import glob
+import hashlib
+import importlib
+import os
+import signal
+import sys
+
+from assetcache import file_digest
+import sngparser
+
+POLL_TIMEOUT = 3600 # seconds, lets the wait for results be interrupted
+SOURCES = ['xml2sng.py', 'sngparser.py'] # files of an implementation
+STATUSES = ['identical', 'different', 'failed'] # by severity
+LABELS = {'candidate' : '', 'joint' : ', compiled with its song'}
+
+
+def find_xmls(paths):
+    """Sorted list of the XML files of paths, being files, globs or
+    directories"""
+    xmls = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                for filename in fnmatch.filter(filenames, '*.xml'):
+                    xmls.add(os.path.join(dirpath, filename))
+        else:
+            xmls.update(f for f in glob.glob(path) if os.path.isfile(f))
+    return sorted(xmls)
+
+def song_groups(filenames):
+    """Lists of the XML files of each song, those of a directory with the
+    same name before the last underscore"""
+    groups = {}
+    for filename in filenames:
+        directory, name = os.path.split(filename)
+        key = (directory, name.rsplit('_', 1)[0] if '_' in name else '')
+        groups.setdefault(key, []).append(filename)
+    return [groups[key] for key in sorted(groups)]
+
+def implementation_digest(directory):
+    """SHA1 of the sources of an implementation"""
+    sha1 = hashlib.sha1()
+    for source in SOURCES:
+        filename = os.path.join(directory, source)
+        if os.path.exists(filename):
+            sha1.update(source + '\0' + file_digest(filename))
+    return sha1.hexdigest()
+
+
+def next_result(results):
+    """Next result of the queue, waiting as long as the compiles take while
+    letting the wait be interrupted"""
+    while True:
+        try:
+            return results.get(True, POLL_TIMEOUT)
+        except Queue.Empty:
+            pass
+
+
+IMPLEMENTATION = {}
+
+def init_worker(directory):
+    """Pool initializer: import the xml2sng.py of directory, with its own
+    sngparser, no progress output, interruptions left to the parent"""
+    sys.path.insert(0, os.path.abspath(directory))
+    for name in ['xml2sng', 'sngparser', 'stats']:
+        sys.modules.pop(name, None)
+    for name in ['xml2sng', 'sngparser']:
+        IMPLEMENTATION[name] = importlib.import_module(name)
+    sys.stdout = open(os.devnull, 'w')
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def error_message(exc):
+    """Message of a failed compile"""
+    return '{0}: {1}'.format(type(exc).__name__, exc)
+
+def compile_sng(filename):
+    """Compile an XML with the implementation of the worker, through the
+    functions all revisions have. Returns the file name, the binary SNG and
+    an error message."""
+    xml2sng = IMPLEMENTATION['xml2sng']
+    try:
+        xml = xml2sng.load_rsxml(filename)
+        xml2sng.process_sng(xml)
+        return filename, IMPLEMENTATION['sngparser'].SONG.build(xml), None
+    except Exception as exc:
+        return filename, None, error_message(exc)
+
+def compile_song(filenames):
+    """Compile the arrangements of a song together through the compile_xmls
+    of the worker. Returns the list of compile_sng results, a failed XML
+    leaving the next ones to a new compile_xmls."""
+    xml2sng = IMPLEMENTATION['xml2sng']
+    output = []
+    while len(output) < len(filenames):
+        try:
+            for filename, _, sng in xml2sng.compile_xmls(
+                                        filenames[len(output):]):
+                output.append((filename, sng, None))
+        except Exception as exc:
+            output.append((filenames[len(output)], None, error_message(exc)))
+    return output
+
+
+def field_path(path, key):
+    """Path of a field of a record"""
+    return path + '.' + key if path else key
+
+def diff_fields(reference, candidate, path='', output=None, limit=10):
+    """List of (path, reference value, candidate value) of the fields of two
+    decoded SNG that differ, at most limit"""
+    output = [] if output is None else output
+    if len(output) >= limit:
+        return output
+
+    if isinstance(reference, dict) and isinstance(candidate, dict):
+        for key in sorted(set(reference) | set(candidate)):
+            diff_fields(reference.get(key), candidate.get(key),
+                        field_path(path, key), output, limit)
+    elif isinstance(reference, list) and isinstance(candidate, list):
+        if len(reference) != len(candidate):
+            output.append((field_path(path, 'count'), len(reference),
+                           len(candidate)))
+        for i, values in enumerate(zip(reference, candidate)):
+            diff_fields(values[0], values[1], '{0}[{1}]'.format(path, i),
+                        output, limit)
+    elif reference != candidate:
+        output.append((path, reference, candidate))
+
+    return output[:limit]
+
+def first_difference(reference, candidate):
+    """Offset of the first byte that differs"""
+    for offset, (a, b) in enumerate(zip(reference, candidate)):
+        if a != b:
+            return offset
+    return min(len(reference), len(candidate))
+
+def compare(reference, candidate, limit=10):
+    """Compare two compile results, (SNG, error) pairs. Returns the status,
+    identical, different or failed, and the lines of the report."""
+    (ref_sng, ref_error), (cand_sng, cand_error) = reference, candidate
+    if ref_error or cand_error:
+        if ref_error == cand_error:
+            return 'identical', []
+        return 'failed', ['reference: ' + (ref_error or 'ok'),
+                          'candidate: ' + (cand_error or 'ok')]
+
+    if ref_sng == cand_sng:
+        return 'identical', []
+
+    lines = ['first difference at byte {0}, sizes {1} and {2}'.format(
+                first_difference(ref_sng, cand_sng), len(ref_sng),
+                len(cand_sng))]
+    try:
+        fields = diff_fields(sngparser.SONG.parse(ref_sng),
+                             sngparser.SONG.parse(cand_sng), limit=limit)
+    except Exception as exc:
+        lines.append('cannot decode: {0}: {1}'.format(type(exc).__name__, exc))
+    else:
+        lines += ['{0}: {1!r} != {2!r}'.format(*field) for field in fields]
+    return 'different', lines
+
+
+def run(reference, candidate, filenames, jobs=None, cache=None, limit=10,
+        joint=False):
+    """Compile the XML files with both implementations and compare them,
+    printing the differences, joint to compile the songs of the candidate
+    together as well. Returns a dictionary status -> count, the worst status
+    of each XML."""
+    jobs = jobs or max(1, cpu_count() // 2)
+    prefix = implementation_digest(reference)
+    if cache and not os.path.exists(cache):
+        os.makedirs(cache)
+
+    def cache_file(filename):
+        """Cache entry of the reference SNG of an XML"""
+        key = hashlib.sha1(prefix + file_digest(filename)).hexdigest()
+        return os.path.join(cache, key + '.sng')
+
+    def put_song(output):
+        """Queue the results of a joint compile"""
+        for result in output:
+            results.put(('joint',) + result)
+
+    results = Queue.Queue()
+    pools = {}
+    sides = ['candidate', 'joint'] if joint else ['candidate']
+    counts = dict((status, 0) for status in STATUSES)
+    try:
+        for side, directory in [('reference', reference),
+                                ('candidate', candidate)]:
+            pools[side] = Pool(jobs, init_worker, (directory,))
+
+        for filename in filenames:
+            if cache and os.path.exists(cache_file(filename)):
+                with open(cache_file(filename), 'rb') as fstream:
+                    results.put(('cached', filename, fstream.read(), None))
+            else:
+                pools['reference'].apply_async(compile_sng, (filename,),
+                    callback=lambda r: results.put(('reference',) + r))
+            pools['candidate'].apply_async(compile_sng, (filename,),
+                callback=lambda r: results.put(('candidate',) + r))
+        if joint:
+            for filenames_song in song_groups(filenames):
+                pools['candidate'].apply_async(compile_song,
+                    (filenames_song,), callback=put_song)
+
+        pending = {}
+        for _ in range((len(sides) + 1) * len(filenames)):
+            side, filename, sng, error = next_result(results)
+            if side == 'reference' and cache and sng is not None:
+                with open(cache_file(filename), 'wb') as fstream:
+                    fstream.write(sng)
+
+            compiled = pending.setdefault(filename, {})
+            compiled['reference' if side == 'cached' else side] = (sng, error)
+            if len(compiled) <= len(sides):
+                continue
+
+            del pending[filename]
+            statuses = []
+            for side in sides:
+                status, lines = compare(compiled['reference'], compiled[side],
+                                        limit)
+                statuses.append(status)
+                if status != 'identical':
+                    print '{0}: {1}{2}'.format(filename, status, LABELS[side])
+                    for line in lines:
+                        print '    ' + line
+                    sys.stdout.flush()
+            counts[max(statuses, key=STATUSES.index)] += 1
+    finally:
+        for pool in pools.values():
+            pool.terminate()
+            pool.join()
+
+    return counts
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    xmls = find_xmls(args['PATH'])
+    start = timer()
+    try:
+        counts = run(args['REFERENCE'], args['CANDIDATE'], xmls,
+                     int(args['--jobs']) if args['--jobs'] else None,
+                     args['--cache'], int(args['--fields']), args['--joint'])
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+    print '{0} XML in {1:.1f}s: {identical} identical, {different} ' \
+          'different, {failed} failed'.format(len(xmls), timer() - start,
+                                              **counts)
+    if counts['different'] or counts['failed']:
+        sys.exit(1)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Time window queries over the levels of a parsed SNG, for renderers asking
+what is on screen at every frame.
+
+The items of each kind of a level are kept sorted by start time, with a
+centered interval tree of their spans, sustains included. A window query
+bisects the items starting in the window and asks the tree for those
+starting before it and still sounding, finding the k items in O(log n + k)
+however long they are, instead of filtering the whole level. Levels are
+indexed on first use.
+
+    >>> from sngparser import SONG
+    >>> from sngindex import SongIndex
+    >>> index = SongIndex(SONG.parse(open('myfile.sng', 'rb').read()))
+    >>> items = index.window(level, 10.0, 12.5)
+    >>> items['notes'], items['chords'], items['anchors'], items['handshapes']
+
+The command line prints the start and end times of the items of a window.
+
+Usage: sngindex.py [--level=N] SNG START END
+
+Options:
+    --level=N   Difficulty level, the hardest by default.
+"""
+
+from bisect import bisect_left, bisect_right
+from operator import attrgetter
+
+
+def notes(level):
+    """Single notes of a level"""
+    return [note for note in level.notes if note.chordId == -1]
+
+def chords(level):
+    """Chords of a level"""
+    return [note for note in level.notes if note.chordId != -1]
+
+def note_end(note):
+    """End time of a note or chord, its sustain included"""
+    return note.time + note.sustain
+
+# Kind -> items of a level, their start and end times
+KINDS = {
+    'notes'      : (notes, attrgetter('time'), note_end),
+    'chords'     : (chords, attrgetter('time'), note_end),
+    'anchors'    : (attrgetter('anchors'), attrgetter('time'),
+                    attrgetter('endTime')),
+    'arpeggios'  : (lambda level: level.fingerPrints[0],
+                    attrgetter('startTime'), attrgetter('endTime')),
+    'handshapes' : (lambda level: level.fingerPrints[1],
+                    attrgetter('startTime'), attrgetter('endTime'))
+}
+
+
+def interval_tree(indices, starts, ends):
+    """Centered interval tree of the items of indices, sorted by start time.
+    A node is the center, the items spanning it by start time and by end time
+    decreasing, and the subtrees of the items ending before and starting
+    after it. None without items."""
+    if not indices:
+        return None
+
+    center = starts[indices[len(indices) // 2]]
+    before = [i for i in indices if ends[i] < center]
+    after = [i for i in indices if starts[i] > center]
+    spanning = [i for i in indices if starts[i] <= center <= ends[i]]
+    return (center, spanning,
+            sorted(spanning, key=ends.__getitem__, reverse=True),
+            interval_tree(before, starts, ends),
+            interval_tree(after, starts, ends))
+
+class IntervalIndex(object):
+    """Items with a start and end time, queried by time window"""
+
+    def __init__(self, items, start, end):
+        starts = [start(item) for item in items]
+        if any(a > b for a, b in zip(starts, starts[1:])):
+            order = sorted(range(len(items)), key=starts.__getitem__)
+            items = [items[i] for i in order]
+            starts = [starts[i] for i in order]
+
+        self.items = items
+        self.starts = starts
+        self.ends = [max(s, end(item)) for s, item in zip(starts, items)]
+        self.tree = interval_tree(range(len(items)), self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.items)
+
+    def sounding(self, time):
+        """Indices of the items starting before time and ending at or after
+        it, by start time"""
+        output = []
+        node = self.tree
+        while node is not None:
+            center, by_start, by_end, before, after = node
+            if time < center:
+                # All end after time, those starting before it are first
+                for i in by_start:
+                    if self.starts[i] >= time:
+                        break
+                    output.append(i)
+                node = before
+            else:
+                # All start at or before time, those ending after it are first
+                for i in by_end:
+                    if self.ends[i] < time:
+                        break
+                    if self.starts[i] < time:
+                        output.append(i)
+                node = after if time > center else None
+        return sorted(output)
+
+    def window(self, start, end):
+        """Items overlapping [start, end], by start time"""
+        first = bisect_left(self.starts, start)
+        stop = bisect_right(self.starts, end, first)
+        return [self.items[i] for i in self.sounding(start)] + \
+               self.items[first:stop]
+
+    def at(self, time):
+        """Items sounding or held at a time"""
+        return self.window(time, time)
+
+class SongIndex(object):
+    """Index of the levels of a SNG parsed by sngparser"""
+
+    def __init__(self, sng):
+        self.sng = sng
+        self.levels = {}
+
+    def level(self, difficulty):
+        """Dictionary kind -> IntervalIndex of a level"""
+        if difficulty not in self.levels:
+            level = self.sng.levels[difficulty]
+            self.levels[difficulty] = dict(
+                (kind, IntervalIndex(items(level), start, end))
+                for kind, (items, start, end) in KINDS.items())
+        return self.levels[difficulty]
+
+    def window(self, difficulty, start, end):
+        """Dictionary kind -> items of a level overlapping [start, end]"""
+        return dict((kind, index.window(start, end))
+                    for kind, index in self.level(difficulty).items())
+
+if __name__ == '__main__':
+    from docopt import docopt
+    from sngparser import SONG
+
+    args = docopt(__doc__)
+    with open(args['SNG'], 'rb') as fstream:
+        song = SongIndex(SONG.parse(fstream.read()))
+
+    difficulty = len(song.sng.levels) - 1
+    if args['--level'] is not None:
+        difficulty = int(args['--level'])
+
+    items = song.window(difficulty, float(args['START']), float(args['END']))
+    for kind in sorted(items):
+        _, start, end = KINDS[kind]
+        print '{0}: {1}'.format(kind, ' '.join(
+            '{0:.3f}-{1:.3f}'.format(start(item), end(item))
+            for item in items[kind]))
@@ -0,0 +1,187 @@
+"""
+Stage timers and counters for psarc.py and xml2sng.py, see --stats and
+--profile.
+
+The hot functions listed in STAGES are wrapped only while a session is
+active, so instrumentation costs nothing when disabled. Each stage records
+its calls, inclusive time and bytes produced. Nested stages are included in
+the time of their callers.
+
+With --profile, each outermost stage is profiled with cProfile and dumped to
+DIRECTORY/STAGE.prof, to be read with pstats. With --memory, the peak memory
+is measured with tracemalloc when available, the peak resident size of the
+process otherwise.
+"""
+
+from contextlib import contextmanager
+from timeit import default_timer as timer
+import cProfile
+import json
+import os
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+MB = 1024.0**2
+
+# Timed functions of each module
+STAGES = {
+    'psarc'   : ['read_toc', 'read_entry', 'read_block', 'aes_ctr',
+                 'decrypt_sng', 'compress_sng', 'encrypt_sng', 'create_entry',
+                 'create_toc', 'write_psarcs', 'path2dict'],
+    'xml2sng' : ['load_rsxml', 'process_sng', 'song_timing', 'process_ebeats',
+                 'compile_chord_templates', 'process_phrase_iterations',
+                 'process_sections', 'process_level', 'process_metadata',
+                 'build_sng']
+}
+
+ENABLED = False
+TIMERS = {}   # stage -> [calls, seconds, bytes]
+COUNTERS = {} # name -> value
+PROFILES = {} # stage -> cProfile.Profile
+ACTIVE = []   # stages being profiled
+
+
+def result_size(result):
+    """Bytes produced by a stage, None if unknown"""
+    if isinstance(result, str):
+        return len(result)
+    if isinstance(result, dict) and 'length' in result:
+        return result['length']
+    return None
+
+def timed(stage, function, profile):
+    """Timed version of function"""
+    def wrapper(*args, **kwargs):
+        profiler = None
+        if profile and not ACTIVE:
+            profiler = PROFILES.setdefault(stage, cProfile.Profile())
+            ACTIVE.append(stage)
+            profiler.enable()
+
+        start = timer()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            elapsed = timer() - start
+            if profiler is not None:
+                profiler.disable()
+                ACTIVE.pop()
+
+        record = TIMERS.setdefault(stage, [0, 0.0, 0])
+        record[0] += 1
+        record[1] += elapsed
+        record[2] += result_size(result) or 0
+        return result
+    return wrapper
+
+def module_name(module):
+    """Name of a module, even when run as a script"""
+    return os.path.splitext(os.path.basename(module.__file__))[0]
+
+def instrument(module, profile=False):
+    """Wrap the stages of a module, returns the original functions"""
+    name = module_name(module)
+    originals = {}
+    for function in STAGES.get(name, []):
+        originals[function] = getattr(module, function)
+        setattr(module, function, timed(name + '.' + function,
+                                        originals[function], profile))
+    return originals
+
+def count(name, value=1):
+    """Add value to a counter, while a session is active. Value is computed
+    by the caller in any case, it must be at hand as a length."""
+    if ENABLED:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+def peak_memory():
+    """Peak memory in bytes and how it was measured"""
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[1], 'tracemalloc'
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on OSX
+    return peak * (1 if sys.platform == 'darwin' else 1024), 'rusage'
+
+def report(seconds, memory=False, profiles=None):
+    """Report of the stages and counters as a dictionary"""
+    stages = {}
+    for stage, (calls, elapsed, size) in TIMERS.items():
+        stages[stage] = {
+            'calls'   : calls,
+            'seconds' : elapsed
+        }
+        if size:
+            stages[stage]['bytes'] = size
+            stages[stage]['MB/s'] = size / MB / elapsed if elapsed else 0.0
+
+    output = {
+        'command'  : [os.path.basename(sys.argv[0])] + sys.argv[1:],
+        'date'     : time.strftime('%Y-%m-%d %H:%M:%S'),
+        'seconds'  : seconds,
+        'stages'   : stages,
+        'counters' : dict(COUNTERS)
+    }
+    if memory:
+        peak, source = peak_memory()
+        output['memory'] = {'peak' : peak, 'source' : source}
+    if profiles:
+        output['profiles'] = profiles
+    return output
+
+def dump_profiles(directory):
+    """Write the profile of each stage, returns a dictionary stage -> file"""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    output = {}
+    for stage, profiler in PROFILES.items():
+        filename = os.path.join(directory, stage + '.prof')
+        profiler.dump_stats(filename)
+        output[stage] = filename
+    return output
+
+@contextmanager
+def session(module, filename=None, profile=None, memory=False):
+    """Instrument a module while in the context. The JSON report goes to
+    filename, '-' for stderr, and profiles to the profile directory. Does
+    nothing without either."""
+    global ENABLED
+    if not filename and not profile:
+        yield
+        return
+
+    TIMERS.clear()
+    COUNTERS.clear()
+    PROFILES.clear()
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+
+    originals = instrument(module, bool(profile))
+    ENABLED = True
+    start = timer()
+    try:
+        yield
+    finally:
+        seconds = timer() - start
+        ENABLED = False
+        for function, original in originals.items():
+            setattr(module, function, original)
+
+        profiles = dump_profiles(profile) if profile else None
+        output = report(seconds, memory, profiles)
+        if memory and tracemalloc is not None:
+            tracemalloc.stop()
+
+        if filename == '-':
+            json.dump(output, sys.stderr, indent=2, sort_keys=True)
+            sys.stderr.write('\n')
+        elif filename:
+            with open(filename, 'w') as fstream:
+                json.dump(output, fstream, indent=2, sort_keys=True)
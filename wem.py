@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+Read the metadata of Audiokinetic WEM files without decoding any audio:
+channels, sample rate, sample count, duration and loop points.
+
+Only the RIFF chunks preceding the audio data are read, so metadata can be
+read from a PSARC entry stream at the cost of a few KB.
+
+Usage:
+    wem.py psarc ARCHIVE...
+    wem.py FILE...
+"""
+
+import json
+import struct
+
+CODEC_VORBIS = 0xFFFF
+
+# Chunks read, others are skipped
+CHUNKS = ['fmt ', 'vorb', 'smpl']
+MAX_CHUNK_SIZE = 65536
+
+
+class WemError(Exception):
+    """Not a valid WEM"""
+    pass
+
+
+def read_chunks(fstream):
+    """Read the chunks preceding the audio data. Returns the endianness
+    prefix for struct, a dictionary chunk id -> (offset, content) and the
+    offset and size of the data chunk."""
+    riff = fstream.read(12)
+    if len(riff) < 12 or riff[:4] not in ('RIFF', 'RIFX') or \
+            riff[8:] != 'WAVE':
+        raise WemError('not a RIFF WAVE file')
+    endian = '<' if riff[:4] == 'RIFF' else '>'
+
+    chunks = {}
+    offset = 12
+    while True:
+        header = fstream.read(8)
+        if len(header) < 8:
+            raise WemError('no data chunk')
+        chunk_id, size = struct.unpack(endian + '4sL', header)
+        offset += 8
+
+        if chunk_id == 'data':
+            return endian, chunks, offset, size
+
+        if chunk_id in CHUNKS:
+            if size > MAX_CHUNK_SIZE:
+                raise WemError('{0} chunk too large'.format(chunk_id))
+            content = fstream.read(size)
+            if len(content) < size:
+                raise WemError('truncated {0} chunk'.format(chunk_id))
+            chunks[chunk_id] = (offset, content)
+
+        # Skip to the next chunk, chunks are word aligned
+        offset += size + size % 2
+        fstream.seek(offset)
+
+def read_wem(fstream):
+    """Metadata of a WEM from a seekable file object positioned at its
+    start"""
+    endian, chunks, data_offset, data_size = read_chunks(fstream)
+    if 'fmt ' not in chunks:
+        raise WemError('no fmt chunk')
+
+    fmt = chunks['fmt '][1]
+    if len(fmt) < 0x10:
+        raise WemError('fmt chunk too small')
+    codec, channels, sample_rate, avg_bytes, block_align = \
+        struct.unpack(endian + 'HHLLH', fmt[:14])
+
+    info = {
+        'codec'                : codec,
+        'channels'             : channels,
+        'sample_rate'          : sample_rate,
+        'avg_bytes_per_second' : avg_bytes,
+        'data_offset'          : data_offset,
+        'data_size'            : data_size,
+        'loop'                 : None
+    }
+
+    if codec == CODEC_VORBIS:
+        # Without a vorb chunk, its content follows the extended fmt
+        vorb = chunks['vorb'][1] if 'vorb' in chunks else fmt[0x18:]
+        if len(vorb) < 4:
+            raise WemError('no vorb header')
+        info['sample_count'] = struct.unpack(endian + 'L', vorb[:4])[0]
+    elif block_align:
+        info['sample_count'] = data_size // block_align
+    else:
+        raise WemError('cannot count samples of codec {0:#x}'.format(codec))
+
+    if 'smpl' in chunks:
+        smpl = chunks['smpl'][1]
+        if len(smpl) >= 0x34:
+            loop_count = struct.unpack(endian + 'L', smpl[0x1C:0x20])[0]
+            if loop_count > 0:
+                info['loop'] = struct.unpack(endian + 'LL', smpl[0x2C:0x34])
+
+    info['duration'] = info['sample_count'] / float(sample_rate) \
+                        if sample_rate else 0.0
+    return info
+
+def wem_info(filename):
+    """Metadata of a WEM file"""
+    with open(filename, 'rb') as fstream:
+        return read_wem(fstream)
+
+def psarc_info(filename):
+    """Metadata of every WEM of a PSARC, as a dictionary filepath -> info"""
+    from psarc import Archive
+
+    output = {}
+    with Archive(filename) as archive:
+        for filepath in sorted(archive.index):
+            if filepath.endswith('.wem'):
+                output[filepath] = read_wem(archive.open(filepath))
+    return output
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    if args['psarc']:
+        for f in args['ARCHIVE']:
+            for filepath, info in sorted(psarc_info(f).items()):
+                print json.dumps(dict(info, file=f, filepath=filepath))
+    else:
+        for f in args['FILE']:
+            print json.dumps(dict(wem_info(f), file=f))
@@ -3,27 +3,27 @@
 """
 Generate Wwise banks suitable for Rocksmith from an Audiokinetic WEM file.
 
-Usage: wem2bnk.py [options] --fileid=ID FILE
+Usage:
+    wem2bnk.py [options] --fileid=ID FILE
+    wem2bnk.py batch [--jobs=N] [--volume=VOL] FILE...
+
+In batch mode, IDs are derived from the file names and a WEM whose name ends
+with _preview gets a preview soundbank.
 
 Options:
     --preview       Generate a preview soundbank.
     --volume=VOL    Set volume. [default: -5.0]
+    --jobs=N        Number of worker processes, all cores by default.
 """
-import random
 import struct
 import os
+import io
+import sys
 # import shutil
 
 CHUNK_SIZE = 51200
 
-PREVIEW = False
-VOLUME  = -5.0
-FILE_ID = random.randint(0, 2**32)
-
-SOUND_ID  = random.randint(0, 2**32)
-BANK_ID   = random.randint(0, 2**32)
-ACTION_ID = random.randint(0, 2**32)
-BUS_ID    = random.randint(0, 2**32)
+VOLUME = -5.0
 
 # True constants
 MIXER_ID         = 0x26c77444
@@ -33,96 +33,175 @@ PARENT_BUS_ID    = 0x9bf0fc29
 UNK_ID           = 0xf908c29a
 UNK_ID2          = 0x10100
 
-def section(section_name, content):
-    """Append header to a section"""
-
-    return section_name + struct.pack('<L', len(content)) + content
-
-def header():
-    """Header section"""
-
-    bkhd = struct.pack('<LL', 91, BANK_ID)
+def fnv_hash(name):
+    """32 bits FNV-1 hash of the lower case name, as Wwise short IDs"""
+    value = 2166136261
+    for c in name.lower():
+        value = (value * 16777619) & 0xffffffff
+        value ^= ord(c)
+    return value
+
+def bank_ids(name, file_id=None):
+    """Deterministic IDs for the soundbank of name"""
+    ids = {
+        'bank'   : fnv_hash('Song_' + name),
+        'event'  : fnv_hash('Play_' + name),
+        'sound'  : fnv_hash('Sound_' + name),
+        'action' : fnv_hash('Action_' + name),
+        'bus'    : fnv_hash('Bus_' + name),
+        'file'   : fnv_hash(name)
+    }
+    if file_id is not None:
+        ids['file'] = file_id
+    return ids
+
+# Fixed size structures. Zero fields and padding are part of the formats.
+SECTION = struct.Struct('<4sL')
+BKHD    = struct.Struct('<LL20x')
+DIDX    = struct.Struct('<LLL')
+HIRC    = struct.Struct('<L')
+OBJECT  = struct.Struct('<BL')
+SOUND   = struct.Struct('<LLLLL3xLLLL3xBxBBfLL6xBBxH2xB11x')
+MIXER   = struct.Struct('<LHLLLL22xHLL')
+ACTION  = struct.Struct('<LHL3xBL')
+EVENT   = struct.Struct('<LLL')
+STID    = struct.Struct('<LLLB')
+
+HIRC_SIZE = HIRC.size + 4 * OBJECT.size + \
+            SOUND.size + MIXER.size + ACTION.size + EVENT.size
+
+def bnk_size(name, data_size):
+    """Size of a soundbank, computed before building it"""
+    return 5 * SECTION.size + BKHD.size + DIDX.size + data_size + \
+           HIRC_SIZE + STID.size + len('Song_' + name)
+
+def pack_section(buf, offset, section_name, size):
+    """Pack a section header, returns the offset of the content"""
+    SECTION.pack_into(buf, offset, section_name, size)
+    return offset + SECTION.size
+
+def pack_object(buf, offset, kind, fmt, *values):
+    """Pack a hierarchy object, returns the offset following it"""
+    OBJECT.pack_into(buf, offset, kind, fmt.size)
+    fmt.pack_into(buf, offset + OBJECT.size, *values)
+    return offset + OBJECT.size + fmt.size
+
+def pack_hierarchy(buf, offset, ids, preview, volume):
+    """Hierarchy section content: sound, mixer, action and event"""
+    preview = int(preview)
+
+    HIRC.pack_into(buf, offset, 4)
+    offset += HIRC.size
+    offset = pack_object(buf, offset, 2, SOUND,
+        ids['sound'], PLUGIN_ID, 2, ids['file'], ids['file'],
+        ids['bus'], DIRECT_PARENT_ID, UNK_ID*preview, MIXER_ID,
+        3, 0x2e, 0x2f, volume, 1, 3, preview, preview, preview, preview)
+    offset = pack_object(buf, offset, 7, MIXER,
+        MIXER_ID, 0, PARENT_BUS_ID, 0, 0, UNK_ID2, 0, 1, ids['sound'])
+    offset = pack_object(buf, offset, 3, ACTION,
+        ids['action'], 0x403, ids['sound'], 4, ids['bank'])
+    offset = pack_object(buf, offset, 4, EVENT, ids['event'], 1, ids['action'])
+    return offset
+
+def pack_bnk(buf, name, data_size, ids, preview=False, volume=VOLUME):
+    """Pack a soundbank into buf, sized with bnk_size, but the content of
+    the DATA section. Returns the offset of the DATA content."""
+    name = 'Song_' + name
+
+    offset = pack_section(buf, 0, 'BKHD', BKHD.size)
     # TODO padding function of CHUNK_SIZE
-    bkhd += 20 * chr(0)
-
-    return bkhd
-
-def dataindex():
-    """Data Index section"""
-
-    didx = struct.pack('<LLL', FILE_ID, 0, CHUNK_SIZE)
-    return didx
-
-def hierarchy():
-    """Hierarchy section"""
-
-    # TODO make this tidier and more readable
+    BKHD.pack_into(buf, offset, 91, ids['bank'])
+    offset += BKHD.size
 
-    sound = struct.pack('<LLLLL', SOUND_ID, PLUGIN_ID, 2, FILE_ID, FILE_ID)
-    sound += 3*chr(0)
-    sound += struct.pack('<LL', BUS_ID, DIRECT_PARENT_ID)
-    sound += struct.pack('<LL', UNK_ID*PREVIEW, MIXER_ID)
-    sound += 3*chr(0) + chr(3) + chr(0) + chr(0x2e) + chr(0x2f)
-    sound += struct.pack('<fLL', VOLUME, 1, 3)
-    sound += 6*chr(0) + 2*chr(PREVIEW) + chr(0)
-    sound += struct.pack('<H', PREVIEW)
-    sound += 2*chr(0) + chr(PREVIEW) + 11*chr(0)
+    offset = pack_section(buf, offset, 'DIDX', DIDX.size)
+    DIDX.pack_into(buf, offset, ids['file'], 0, CHUNK_SIZE)
+    offset += DIDX.size
 
-    mixer = struct.pack('<LHLLLL', MIXER_ID, 0, PARENT_BUS_ID, 0, 0, UNK_ID2)
-    mixer += 22*chr(0)
-    mixer += struct.pack('<HLL', 0, 1, SOUND_ID)
+    data_offset = pack_section(buf, offset, 'DATA', data_size)
+    offset = data_offset + data_size
 
-    action = struct.pack('<LHL', ACTION_ID, 0x403, SOUND_ID)
-    action += 3*chr(0) + chr(4)
-    action += struct.pack('<L', BANK_ID)
+    offset = pack_section(buf, offset, 'HIRC', HIRC_SIZE)
+    offset = pack_hierarchy(buf, offset, ids, preview, volume)
 
-    event = struct.pack('<LLL', random.randint(0, 2**32), 1, ACTION_ID)
+    offset = pack_section(buf, offset, 'STID', STID.size + len(name))
+    STID.pack_into(buf, offset, 1, 1, ids['bank'], len(name))
+    offset += STID.size
+    buf[offset:offset + len(name)] = name
 
-    hirc = struct.pack('<L', 4)
-    hirc += struct.pack('<BL', 2, len(sound)) + sound
-    hirc += struct.pack('<BL', 7, len(mixer)) + mixer
-    hirc += struct.pack('<BL', 3, len(action)) + action
-    hirc += struct.pack('<BL', 4, len(event)) + event
+    return data_offset
 
-    return hirc
-
-def stringid(name):
-    """StrindID section"""
-
-    stid = struct.pack('<LLLB', 1, 1, BANK_ID, len(name))
-    stid += name
-    return stid
-
-def build_bnk(name, data):
+def build_bnk(name, data, ids, preview=False, volume=VOLUME):
     """Build a soundbank for the given data chunk"""
-
-    bnk  = section('BKHD', header())
-    bnk += section('DIDX', dataindex())
-    bnk += section('DATA', data)
-    bnk += section('HIRC', hierarchy())
-    bnk += section('STID', stringid('Song_' + name))
-
-    return bnk
-
-if __name__ == '__main__':
+    buf = bytearray(bnk_size(name, len(data)))
+    offset = pack_bnk(buf, name, len(data), ids, preview, volume)
+    buf[offset:offset + len(data)] = data
+    return str(buf)
+
+def write_bnk(stream, name, source, ids, preview=False, volume=VOLUME):
+    """Write a soundbank to stream. The CHUNK_SIZE prefix of the source file
+    object is read straight into the soundbank buffer."""
+    position = source.tell()
+    source.seek(0, os.SEEK_END)
+    data_size = min(CHUNK_SIZE, source.tell() - position)
+    source.seek(position)
+
+    buf = bytearray(bnk_size(name, data_size))
+    offset = pack_bnk(buf, name, data_size, ids, preview, volume)
+
+    view = memoryview(buf)[offset:offset + data_size]
+    while len(view):
+        count = source.readinto(view)
+        if not count:
+            raise IOError('Unexpected end of file')
+        view = view[count:]
+
+    stream.write(buf)
+
+def wem2bnk(filename, file_id=None, preview=False, volume=VOLUME,
+            outdir=''):
+    """Write the soundbank of a WEM file, returns the soundbank file name"""
+    base = os.path.basename(os.path.splitext(filename)[0])
+
+    ids = bank_ids(base, file_id)
+    output = os.path.join(outdir, 'song_' + base.lower() + '.bnk')
+    with io.open(filename, 'rb') as source:
+        with open(output, 'wb') as fstream:
+            write_bnk(fstream, base, source, ids, preview, volume)
+
+    return output
+
+def batch_job(args):
+    """Pool job for wem2bnk, preview banks for *_preview WEM"""
+    filename, volume = args
+    base = os.path.basename(os.path.splitext(filename)[0])
+    preview = base.lower().endswith('_preview')
+    return wem2bnk(filename, preview=preview, volume=volume)
+
+def batch(filenames, volume=VOLUME, jobs=None):
+    """Build the soundbanks of many WEM files across a process pool"""
+    from multiprocessing import Pool
+
+    pool = Pool(jobs)
+    try:
+        for output in pool.imap(batch_job, [(f, volume) for f in filenames]):
+            print output
+    finally:
+        pool.close()
+        pool.join()
+
+def main(argv=None):
+    """Command line, returns the exit status"""
     from docopt import docopt
-    args = docopt(__doc__)
-
-    if args['--preview']:
-        PREVIEW = True
+    args = docopt(__doc__, argv)
 
-    FILE_ID = int(args['FILE_ID'])
-    VOLUME  = float(args['--volume'])
+    if args['batch']:
+        jobs = int(args['--jobs']) if args['--jobs'] else None
+        batch(args['FILE'], float(args['--volume']), jobs)
+    else:
+        wem2bnk(args['FILE'][0], int(args['--fileid']), args['--preview'],
+                float(args['--volume']))
 
-    f = os.path.basename(args['FILE'])
-    base = os.path.basename(os.path.splitext(f)[0])
+    return 0
 
-    chunk = ''
-    with open(args['FILE'], 'rb') as fstream:
-        chunk = fstream.read(CHUNK_SIZE)
-        # with open(str(FILE_ID) + '.wem', 'wb') as cstream:
-        #     cstream.write(chunk)
-        #     cstream.write(fstream.read())
-
-    with open('song_' + base.lower() + '.bnk', 'wb') as fstream:
-        fstream.write(build_bnk(base, chunk))
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+Run psarc.py, xml2sng.py and wem2bnk.py jobs on a long running local worker,
+saving the interpreter startup and imports of each invocation.
+
+The worker listens on a Unix socket and forks a process per job from its
+warm state, at most --jobs at once. The client relays the job outputs and
+exits with its status, as the script itself would. Without a worker
+listening, the client runs the job itself.
+
+    pack, unpack, convert, merge, diff, patch,
+    verify                                      psarc.py
+    compile                                     xml2sng.py
+    bnk                                         wem2bnk.py
+
+Usage:
+    worker.py [options] serve
+    worker.py [options] JOB [ARGS...]
+
+Options:
+    --socket=PATH   Socket of the worker, $RS_UTILS_SOCKET or
+                    /tmp/rs-utils-UID.sock by default.
+    --jobs=N        Number of jobs run at once, all cores by default.
+
+Example:
+    worker.py --jobs=4 serve &
+    worker.py pack --fast song
+"""
+
+from SocketServer import ForkingMixIn, StreamRequestHandler, UnixStreamServer
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+SOCKET_PATH = os.environ.get('RS_UTILS_SOCKET',
+                             '/tmp/rs-utils-{0}.sock'.format(os.getuid()))
+
+# Job -> module and arguments prepended to the job arguments
+JOBS = {
+    'pack'    : ('psarc', ['pack']),
+    'unpack'  : ('psarc', ['unpack']),
+    'convert' : ('psarc', ['convert']),
+    'merge'   : ('psarc', ['merge']),
+    'diff'    : ('psarc', ['diff']),
+    'patch'   : ('psarc', ['patch']),
+    'verify'  : ('psarc', ['verify']),
+    'compile' : ('xml2sng', []),
+    'bnk'     : ('wem2bnk', [])
+}
+
+# Frames sent back to the client: stdout, stderr and exit status
+FRAME = struct.Struct('>cL')
+STDOUT = 'O'
+STDERR = 'E'
+STATUS = 'X'
+
+
+def run_job(job, args):
+    """Run a job in this process, returns its exit status"""
+    if job not in JOBS:
+        sys.stderr.write('Unknown job {0}\n'.format(job))
+        return 1
+
+    module, prefix = JOBS[job]
+    try:
+        return importlib.import_module(module).main(prefix + args) or 0
+    except SystemExit as exc:
+        # As the interpreter does for docopt usage errors and sys.exit
+        if exc.code is None or isinstance(exc.code, int):
+            return exc.code or 0
+        sys.stderr.write(str(exc.code) + '\n')
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+
+
+class FrameWriter(object):
+    """File object sending what is written as frames of a kind"""
+
+    def __init__(self, stream, kind):
+        self.stream = stream
+        self.kind = kind
+
+    def write(self, data):
+        """Send data"""
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            self.stream.write(FRAME.pack(self.kind, len(data)) + data)
+
+    def flush(self):
+        """Frames are sent as written"""
+        pass
+
+def read_frame(stream):
+    """Kind and data of the next frame, None at the end of the stream"""
+    header = stream.read(FRAME.size)
+    if len(header) < FRAME.size:
+        return None, None
+    kind, size = FRAME.unpack(header)
+    return kind, stream.read(size)
+
+
+class JobHandler(StreamRequestHandler):
+    """Run the job of a request, in its own forked process"""
+
+    def handle(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        request = json.loads(self.rfile.readline())
+        os.chdir(request['cwd'].encode('utf-8'))
+        args = [arg.encode('utf-8') for arg in request['args']]
+
+        sys.stdout = FrameWriter(self.wfile, STDOUT)
+        sys.stderr = FrameWriter(self.wfile, STDERR)
+        try:
+            status = run_job(request['job'], args)
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+
+        self.wfile.write(FRAME.pack(STATUS, 4) + struct.pack('>l', status))
+
+class WorkerServer(ForkingMixIn, UnixStreamServer):
+    """Unix socket server forking a process per job"""
+    pass
+
+def serve(path=SOCKET_PATH, jobs=None):
+    """Import the job modules then serve jobs until interrupted or
+    terminated"""
+    for module in set(module for module, _ in JOBS.values()):
+        importlib.import_module(module)
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = WorkerServer(path, JobHandler)
+    server.max_children = jobs or multiprocessing.cpu_count()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print 'Serving on {0}, {1} jobs at once'.format(path, server.max_children)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def run(job, args, path=SOCKET_PATH):
+    """Run a job on the worker, relaying its outputs. Returns its exit
+    status, None if no worker is listening."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+
+    try:
+        sock.sendall(json.dumps({
+            'job'  : job,
+            'args' : args,
+            'cwd'  : os.getcwd()
+        }) + '\n')
+
+        stream = sock.makefile('rb')
+        while True:
+            kind, data = read_frame(stream)
+            if kind == STDOUT:
+                sys.stdout.write(data)
+                sys.stdout.flush()
+            elif kind == STDERR:
+                sys.stderr.write(data)
+                sys.stderr.flush()
+            elif kind == STATUS:
+                return struct.unpack('>l', data)[0]
+            else:
+                sys.stderr.write('Worker closed the connection\n')
+                return 1
+    finally:
+        sock.close()
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__, options_first=True)
+    path = args['--socket'] or SOCKET_PATH
+
+    if args['serve']:
+        serve(path, int(args['--jobs']) if args['--jobs'] else None)
+    else:
+        status = run(args['JOB'], args['ARGS'], path)
+        if status is None:
+            status = run_job(args['JOB'], args['ARGS'])
+        sys.exit(status)
@@ -3,11 +3,26 @@
 """
 Generate JSON manifest and binary SNG for Rocksmith 2014 from source SNG XML.
 
-Usage: xml2sng.py FILE...
+The arrangements of a song given together share their song timing, beat
+numbering and phrase iteration times, computed once, see song_timing.
+
+Usage: xml2sng.py [--stats=FILE --profile=DIR --memory] FILE...
+
+Options:
+    --stats=FILE    Write timers and counters of the run as JSON to FILE, -
+                    for stderr. See stats.py.
+    --profile=DIR   Write a cProfile dump per stage to DIR.
+    --memory        Report the peak memory with --stats.
 """
 
 from xml.etree import cElementTree as ET
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 import binascii
+import os
+import sys
+import sngparser
+import stats
 
 def coerce_value(v):
     try:
@@ -128,39 +143,73 @@ def note_mask(note, single):
     mask |= NOTE_MASK_VIBRATO          if note.vibrato != 0              else 0
     return mask
 
+TIMING_CACHE = 16 # song timings kept by compile_xmls
+
 def get_phraseiteration(sng, time, include_end=False):
-    """Returns the index of the phrase iteration containing time."""
+    """Returns the index of the phrase iteration containing time. The phrase
+    iteration times of the song timing are bisected when sorted."""
+    timing = sng.get('timing')
+    if timing is not None and timing.sorted:
+        search = bisect_left if include_end else bisect_right
+        return search(timing.times, time, 1) - 1
+
     for i, piter in enumerate(sng.phraseIterations[1:]):
         if piter.time > time or (include_end and piter.time == time):
             return i
     return len(sng.phraseIterations) - 1
 
-def midi(sng, strg, fret):
-    """Computes standard MIDI note value"""
-
-    if fret == -1:
-        return -1
+def string_bases(sng):
+    """MIDI note value of each open string, tuning applied."""
+    shift = 12 if sng.arrangement == 'Bass' else 0
+    return [MIDI_NOTES[k] + sng.tuning['string'+str(k)] - shift
+            for k in range(6)]
+
+def timing_key(sng):
+    """Inputs of song_timing, equal for the arrangements of a song"""
+    return (sng.songLength,
+            tuple((b.time, b.measure) for b in sng.ebeats),
+            tuple((i.time, i.phraseId) for i in sng.phraseIterations))
+
+def song_timing(sng):
+    """Compute what only depends on timing_key and set it as sng.timing:
+    phrase iteration times, end times and links per phrase, and the measure,
+    beat, mask and phrase iteration of each beat."""
+    times = [i.time for i in sng.phraseIterations]
+    timing = AttrDict({
+        'times'    : times,
+        'sorted'   : len(times) > 0 and \
+                        all(a <= b for a, b in zip(times, times[1:])),
+        'endTimes' : times[1:] + [sng.songLength] if times else [],
+        'links'    : {},
+        'ebeats'   : []
+    })
+    for i in sng.phraseIterations:
+        timing.links[i.phraseId] = timing.links.get(i.phraseId, 0) + 1
+    sng['timing'] = timing
+    stats.count('xml2sng.phrase_iterations', len(times))
+    stats.count('xml2sng.ebeats', len(sng.ebeats))
 
-    base = MIDI_NOTES[strg] + sng.tuning['string'+str(strg)]
-    base -= 12 if sng.arrangement == 'Bass' else 0
+    for k, ebeat in enumerate(sng.ebeats):
+        measure, beat = ebeat.measure, 0
+        if k > 0 and measure <= -1:
+            measure, beat = timing.ebeats[-1][0], timing.ebeats[-1][1] + 1
+        mask = 1 + (measure % 2 == 0) * 2 if beat == 0 else 0
+        timing.ebeats.append((measure, beat, mask,
+                              get_phraseiteration(sng, ebeat.time, True)))
 
-    return base + fret
+    return timing
 
 def process_ebeats(sng):
-    if sng.ebeats:
-        sng.ebeats[0]['beat'] = 0
-    for ebeat, previous in zip(sng.ebeats[1:], sng.ebeats[:-1]):
-        if ebeat.measure > -1:
-            ebeat['beat'] = 0
-        else:
-            ebeat.measure = previous.measure
-            ebeat['beat'] = previous.beat + 1
+    for b, (measure, beat, mask, piter) in zip(sng.ebeats, sng.timing.ebeats):
+        b.measure = measure
+        b['beat'] = beat
+        b['mask'] = mask
+        b['phraseIteration'] = piter
 
-    for b in sng.ebeats:
-        b['mask'] = 1 + (b.measure % 2 == 0) * 2 if b.beat == 0 else 0
-        b['phraseIteration'] = get_phraseiteration(sng, b.time, True)
+def process_chord_template(sng, template, bases=None):
+    if bases is None:
+        bases = string_bases(sng)
 
-def process_chord_template(sng, template):
     template['mask'] = 0
     template.displayName = str(template.displayName)
     if template.displayName.endswith('arp'):
@@ -168,13 +217,43 @@ def process_chord_template(sng, template):
     if template.displayName.endswith('nop'):
         template.mask |= CHORD_MASK_NOP
 
-    template.notes = [midi(sng, k, template['fret'+str(k)]) for k in range(6)]
+    frets = tuple(template['fret'+str(k)] for k in range(6))
+    template.notes = [b + f if f != -1 else -1 for b, f in zip(bases, frets)]
+    return frets
+
+def compile_chord_templates(sng):
+    """Process chord templates and compile them into dense tables indexed by
+    chordId: fret vector, string mask, fretted count, arpeggio flag and MIDI
+    notes. Later passes only do indexed lookups in these tables."""
+    table = AttrDict({
+        'frets'      : [],
+        'stringMask' : [],
+        'fretted'    : [],
+        'arpeggio'   : [],
+        'notes'      : []
+    })
+
+    bases = string_bases(sng)
+    for template in sng.chordTemplates:
+        frets = process_chord_template(sng, template, bases)
+
+        mask = 0
+        for k, fret in enumerate(frets):
+            mask |= 1 << k if fret != -1 else 0
+
+        table.frets.append(frets)
+        table.stringMask.append(mask)
+        table.fretted.append(len([0 for fret in frets if fret != -1]))
+        table.arpeggio.append(template.mask & CHORD_MASK_ARPEGGIO)
+        table.notes.append(template.notes)
+
+    sng['chordTable'] = table
+    stats.count('xml2sng.chord_templates', len(sng.chordTemplates))
+    return table
 
 def process_phrase_iterations(sng):
-    if sng.phraseIterations:
-        sng.phraseIterations[-1]['endTime'] = sng.songLength
-    for i, nexti in zip(sng.phraseIterations[:-1], sng.phraseIterations[1:]):
-        i.endTime = nexti.time
+    for i, end in zip(sng.phraseIterations, sng.timing.endTimes):
+        i['endTime'] = end
 
     for i in sng.phraseIterations:
         i.difficulty = [0, 0, sng.phrases[i.phraseId].maxDifficulty]
@@ -188,6 +267,7 @@ def process_sections(sng):
     for section, nextsection in zip(sng.sections[:-1], sng.sections[1:]):
         section['endTime'] = nextsection.startTime
 
+    stringmasks = sng.chordTable.stringMask
     for section in sng.sections:
         section['startPhraseIterationId'] = \
             get_phraseiteration(sng, section.startTime, False)
@@ -205,14 +285,12 @@ def process_sections(sng):
                     mask |= 1 << note.string
             for chord in level.chords:
                 if section.startTime <= chord.time < section.endTime:
-                    chordtemplate = sng.chordTemplates[chord.chordId]
-                    for i in range(6):
-                        mask |= 1 << i if chordtemplate['fret'+str(i)] > -1 \
-                                       else 0
+                    mask |= stringmasks[chord.chordId]
             if mask == 0 and j < maxdifficulty:
                 mask = stringmask[j+1]
             stringmask[j] = mask
         section['stringMask'] = stringmask
+    stats.count('xml2sng.sections', len(sng.sections))
 
 def process_note(sng, note, single=True):
     note['flags']          = 0
@@ -234,7 +312,17 @@ def process_note(sng, note, single=True):
     note['mask'] = note_mask(note, single)
     note['hash'] = binascii.crc32(str(note.values()))
 
+def freeze(value):
+    """Hashable copy of nested dictionaries and lists, equal when they are"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
 def process_chord_note(sng, chord):
+    """Add the chord notes of a chord to sng.chordNotes unless an equal one
+    is there. Returns its index, -1 without techniques."""
     if not chord.has_key('chordNote'):
         chord.chordNote = []
 
@@ -246,15 +334,8 @@ def process_chord_note(sng, chord):
     slideto        = 6 * [-1]
     slideunpitcho  = 6 * [-1]
     vibrato        = 6 * [0]
-
-    # not using multiplicative notation, nasty bug with dic (references...)
-    bend = [ AttrDict(
-                { 'usedCount' :  0, \
-                  'bendValues': [AttrDict({ 'time': 0.0,
-                                            'step': 0,
-                                            'UNK' : 0}) for _ in range(32)]
-                }) for _ in range(6) ]
-
+    used           = 6 * [0]
+    bends          = [[] for _ in range(6)]
 
     for n in chord.chordNote:
         mask[n.string]          = n.mask
@@ -263,27 +344,41 @@ def process_chord_note(sng, chord):
         slideto[n.string]       = n.slideTo
         slideunpitcho[n.string] = n.slideUnpitchTo
 
-        bend[n.string]['usedCount'] = len(n.bendValues)
-        bend[n.string]['bendValues'][0:len(n.bendValues)] = n.bendValues
+        used[n.string] = len(n.bendValues)
+        bends[n.string][0:len(n.bendValues)] = n.bendValues
 
-    cn = AttrDict({
-        'mask'           : mask,
-        'bendValues32'   : bend,
-        'slideTo'        : slideto,
-        'slideUnpitchTo' : slideunpitcho,
-        'vibrato'        : vibrato
-    })
-    if technique and not cn in sng.chordNotes:
-        sng.chordNotes.append(cn)
+    if not technique:
+        return -1
 
-    return cn
+    # Chord notes are indexed by value instead of compared with each one,
+    # the bend values past those set being the same for all
+    key = (tuple(mask), tuple(slideto), tuple(slideunpitcho), tuple(vibrato),
+           tuple(used), freeze(bends))
+    if key not in sng.chordNoteIds:
+        # not using multiplicative notation, nasty bug with dic (references...)
+        bend = [AttrDict({
+                    'usedCount'  : used[k],
+                    'bendValues' : bends[k] + [AttrDict({'time': 0.0,
+                                                         'step': 0,
+                                                         'UNK' : 0})
+                                        for _ in range(32 - len(bends[k]))]
+                }) for k in range(6)]
+
+        sng.chordNoteIds[key] = len(sng.chordNotes)
+        sng.chordNotes.append(AttrDict({
+            'mask'           : mask,
+            'bendValues32'   : bend,
+            'slideTo'        : slideto,
+            'slideUnpitchTo' : slideunpitcho,
+            'vibrato'        : vibrato
+        }))
+    return sng.chordNoteIds[key]
 
 def process_chord(sng, chord):
-    cn = process_chord_note(sng, chord)
+    chordnote = process_chord_note(sng, chord)
 
     chord['flags']          = 0
-    chord['chordNoteId']    = sng.chordNotes.index(cn) if cn in sng.chordNotes \
-                                else -1
+    chord['chordNoteId']    = chordnote
     chord['string']         = -1
     chord['fret']           = -1
     chord['anchorFret']     = -1
@@ -311,8 +406,7 @@ def process_chord(sng, chord):
     else:
         chord['sustain'] = 0.0
 
-    count = len([0 for k in range(6) if \
-                sng.chordTemplates[chord.chordId]['fret'+str(k)] != -1])
+    count = sng.chordTable.fretted[chord.chordId]
 
     mask = NOTE_MASK_CHORD
     mask |= NOTE_MASK_CHORDNOTES    if chord.chordNoteId > -1 else 0
@@ -347,8 +441,9 @@ def process_level(sng, level):
         h['UNK_endTime']   = 0
 
     level.fingerPrints = []
+    arpeggio = sng.chordTable.arpeggio
     def is_arpeggio(u):
-        return sng.chordTemplates[u.chordId].mask & CHORD_MASK_ARPEGGIO
+        return arpeggio[u.chordId]
     level.fingerPrints.append(filter(is_arpeggio, level.handShapes))
     level.fingerPrints.append(filter(lambda x: not is_arpeggio(x), \
                                 level.handShapes))
@@ -361,6 +456,10 @@ def process_level(sng, level):
         level.notes.append(chord)
 
     level.notes.sort(key=lambda x: x.time)
+    stats.count('xml2sng.levels')
+    stats.count('xml2sng.notes', len(level.notes))
+    stats.count('xml2sng.handshapes', len(level.handShapes))
+    stats.count('xml2sng.anchors', len(level.anchors))
 
     if len(level.notes) and sng.firstNoteTime > level.notes[0].time:
         sng.firstNoteTime = level.notes[0].time
@@ -394,19 +493,18 @@ def process_level(sng, level):
             anchor.UNK_time = anchor.time
             anchor.UNK_time2 = anchor.time + 0.1
 
+    # Notes are sorted, those of an iteration are bisected. The note after
+    # the last one of the iteration, or the last note, ends the links.
+    times = [note.time for note in level.notes]
     for i in sng.phraseIterations:
-        count = 0
-        for j, note in enumerate(level.notes):
-            if note.time < i.time:
-                continue
-            if i.endTime <= note.time:
-                break
-            note.nextIterNote = j+1
-            if count > 0:
-                note.prevIterNote = j-1
-            count += 1
-        if count > 0:
-            level.notes[j].nextIterNote = -1
+        first = bisect_left(times, i.time)
+        end = bisect_left(times, i.endTime, first)
+        for j in range(first, end):
+            level.notes[j].nextIterNote = j+1
+            if j > first:
+                level.notes[j].prevIterNote = j-1
+        if end > first:
+            level.notes[min(end, len(times) - 1)].nextIterNote = -1
 
     for j in range(1, len(level.notes)):
         note = level.notes[j]
@@ -441,12 +539,12 @@ def process_level(sng, level):
     level.notesInIterCount          = len(sng.phraseIterations) * [0]
     level.notesInIterCountNoIgnored = len(sng.phraseIterations) * [0]
     for note in level.notes:
-        for i, piter in enumerate(sng.phraseIterations[1:]):
-            if piter.time > note.time:
-                if note.ignore == 0:
-                    level.notesInIterCountNoIgnored[i] += 1
-                level.notesInIterCount[i] += 1
-                break
+        # Notes after the start of the last iteration are not counted
+        i = get_phraseiteration(sng, note.time)
+        if i < len(sng.phraseIterations) - 1:
+            if note.ignore == 0:
+                level.notesInIterCountNoIgnored[i] += 1
+            level.notesInIterCount[i] += 1
 
     level.averageNotesPerIter = len(sng.phrases) * [0.0]
     iter_count = len(sng.phrases) * [0]
@@ -529,20 +627,21 @@ def process_sng(sng):
     sng['phraseExtraInfoByLevel'] = []
     sng['actions']                = []
     sng['chordNotes']             = []
+    sng['chordNoteIds']           = {}
     if not sng.has_key('vocals'):
         sng['vocals']  = []
         sng['symbols'] = []
     if not sng.has_key('tones'):
         sng['tones'] = []
+    if not sng.has_key('timing'):
+        song_timing(sng)
 
     process_ebeats(sng)
 
     for i, phrase in enumerate(sng.phrases):
-        links = len([0 for pi in sng.phraseIterations if pi.phraseId == i])
-        phrase.phraseIterationLinks = links
+        phrase.phraseIterationLinks = sng.timing.links.get(i, 0)
 
-    for template in sng.chordTemplates:
-        process_chord_template(sng, template)
+    compile_chord_templates(sng)
 
     process_phrase_iterations(sng)
 
@@ -561,24 +660,61 @@ def process_sng(sng):
         process_level(sng, level)
 
     process_metadata(sng)
+    stats.count('xml2sng.chord_notes', len(sng.chordNotes))
+
+
+def sng_filename(filename, sng):
+    """Name of the SNG compiled from a given XML file."""
+    shortname = filter(lambda c: c.isalnum() and not c.isspace(), \
+                        os.path.basename(os.path.splitext(filename)[0])).lower()
+
+    return shortname + '_' + sng.arrangement.lower() + '.sng'
+
+def build_sng(sng):
+    """Binary SNG of a compiled SNG."""
+    return sngparser.SONG.build(sng)
+
+def compile_xml(filename, timings=None):
+    """Load and compile a Rocksmith XML. Timings is a dictionary
+    timing_key -> song timing shared between calls, see compile_xmls.
+    Returns the SNG file name and the binary SNG."""
+    xml = load_rsxml(filename)
+    if timings is not None:
+        key = timing_key(xml)
+        if key in timings:
+            xml['timing'] = timings.pop(key)
+            stats.count('xml2sng.shared_timings')
+        else:
+            song_timing(xml)
+        timings[key] = xml.timing
+        while len(timings) > TIMING_CACHE:
+            timings.popitem(last=False)
 
+    process_sng(xml)
+    return sng_filename(filename, xml), build_sng(xml)
 
-if __name__ == '__main__':
-    from docopt import docopt
-    import sngparser
-    import os
+def compile_xmls(filenames):
+    """Compile Rocksmith XMLs, the arrangements of a song sharing their song
+    timing. Yields the XML file name, SNG file name and binary SNG."""
+    timings = OrderedDict()
+    for filename in filenames:
+        yield (filename,) + compile_xml(filename, timings)
 
-    args = docopt(__doc__)
 
-    for f in args['FILE']:
-        print f
-        xml = load_rsxml(f)
-        process_sng(xml)
+def main(argv=None):
+    """Command line, returns the exit status"""
+    from docopt import docopt
+
+    args = docopt(__doc__, argv)
 
-        shortname = filter(lambda c: c.isalnum() and not c.isspace(), \
-                            os.path.basename(os.path.splitext(f)[0])).lower()
+    with stats.session(sys.modules[__name__], args['--stats'],
+                       args['--profile'], args['--memory']):
+        for f, fname, data in compile_xmls(args['FILE']):
+            print f
+            with open(fname, 'wb') as fstream:
+                fstream.write(data)
 
-        fname = shortname + '_' + xml.arrangement.lower() + '.sng'
+    return 0
 
-        with open(fname, 'wb') as fstream:
-            fstream.write(sngparser.SONG.build(xml))
+if __name__ == '__main__':
+    sys.exit(main())